@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""bench_decode.py
+   Benchmark the receive path: cbf() -> end_of_code() or step() -> decode -> get_commands()
+
+   A synthetic stream of NEC key presses (a code and some repeat codes) with junk bursts
+   mixed in is turned into callback edges once, up front, then fed to a fresh IrReceiver
+   on a ReplayPi for each decoder (buffered and --stream, each with and without
+   --adaptive) and each --tolerance. The tick
+   starts 5 s short of 2**32 so every run crosses the wraparound.
+
+        jitter      each width is scaled by a gaussian with this percent sigma
+        glitches    this percent of transmissions get a 100 to 250 us blip in one width,
+                    the kind that gets past the daemon's glitch filter
+        junk        this percent of transmissions are random bursts, not a code
+        skew        each remote's clock is off by up to this percent, the same for all
+                    its presses
+
+   For each run it measures transmissions/s and CPU us per transmission (timed pass) and
+   the peak memory the receiver allocates (a second pass under tracemalloc), and scores
+   every transmission against what was sent:
+        correct     the command we sent came out
+        missed      nothing came out
+        wrong       a different command came out (a repeat after a missed code repeats
+                    the one before, which counts here)
+        junk        a junk burst came out as a command
+
+   --out saves it all as JSON, --compare prints this run against a saved one, so a
+   change to the receiver can show before and after numbers.
+"""
+
+import json
+import platform
+import random
+import time
+import tracemalloc
+
+import pigpio
+
+from ir_protocols import PROTOCOLS
+from ir_rx import IrReceiver
+from replay import ReplayPi
+
+usage_text = """
+ Usage:
+  bench_decode  [--frames <N>] [--jitter <J>] [--glitches <G>] [--junk <K>] [--skew <W>] [--tolerances <T>] [--seed <S>] [--label <L>] [--out <O>] [--compare <C>]
+  bench_decode -h | --help
+
+ Options:
+  -h --help               Show this screen.
+  -n --frames <N>         Transmissions per run [default: 5000]
+  -j --jitter <J>         Percent sigma of the timing jitter [default: 5]
+  -g --glitches <G>       Percent of transmissions with a glitch [default: 2]
+  -k --junk <K>           Percent of transmissions that are junk [default: 5]
+  -w --skew <W>           Percent a remote's clock can be off [default: 0]
+  -t --tolerances <T>     Comma list of --tolerance values to run [default: 10,15,20,25]
+  -s --seed <S>           Random seed [default: 1]
+  -l --label <L>          What this run is, e.g. a commit, saved in the JSON
+  -o --out <O>            Save the results to this JSON file
+  -c --compare <C>        Print the results against a JSON file saved before
+    """
+
+TICK_MASK = 0xFFFFFFFF
+START_TICK = TICK_MASK + 1 - 5000000
+GAP_US = 120000             # start to start is at least this, over --pre and --post
+ADDRESSES = (122, 120, 7)   # the Yamaha, another Yamaha, the Samsung's address in NEC
+DECODERS = (('buffered', {}),
+            ('stream', {'--stream': True}),
+            ('adaptive', {'--adaptive': True}),
+            ('adapt-st', {'--adaptive': True, '--stream': True}))
+
+
+def jittered(widths, jitter_pct, rng):
+    if not jitter_pct:
+        return [int(width) for width in widths]
+    sigma = jitter_pct * 0.01
+    return [max(int(width * rng.gauss(1.0, sigma)), 1) for width in widths]
+
+
+def glitched(widths, rng):
+    """ Split one width with a 100 to 250 us blip of the other level.
+    """
+    i = rng.randrange(len(widths))
+    width = widths[i]
+    blip = rng.randint(100, 250)
+    if width <= blip + 2:
+        return widths
+    before = rng.randint(1, width - blip - 1)
+    return widths[:i] + [before, blip, width - blip - before] + widths[i+1:]
+
+
+def make_workload(n_frames, jitter_pct, glitch_pct, junk_pct, skew_pct, rng):
+    """ Returns [(edge widths, the command it should give or None)] for n_frames
+        transmissions: key presses of a code then 0 to 3 repeats, and junk.
+    """
+    nec = PROTOCOLS['nec'](0)
+    clocks = {address: 1.0 + rng.uniform(-skew_pct, skew_pct) * 0.01 for address in ADDRESSES}
+    workload = []
+    while len(workload) < n_frames:
+        if rng.random() * 100 < junk_pct:
+            junk = [rng.randint(150, 9500) for _ in range(rng.randint(3, 60))]
+            workload.append((junk, None))
+            continue
+        expected = (rng.choice(ADDRESSES), rng.randrange(256), 'nec')
+        sends = [nec.encode(expected[0], expected[1])]
+        sends += [nec.encode_repeat()] * rng.choice((0, 1, 1, 3))
+        for widths in sends:
+            widths = jittered([width * clocks[expected[0]] for width in widths], jitter_pct, rng)
+            if rng.random() * 100 < glitch_pct:
+                widths = glitched(widths, rng)
+            workload.append((widths, expected))
+    return workload[:n_frames]
+
+
+def to_edges(workload, post_us):
+    """ Turn the widths into what the callback gets: for each transmission the ticks
+        of its edges, the levels after them and the tick a watchdog would go off.
+    """
+    edges = []
+    tick = START_TICK
+    for widths, _ in workload:
+        start = tick
+        ticks = [tick]
+        for width in widths:
+            tick = (tick + width) & TICK_MASK
+            ticks.append(tick)
+        levels = [i & 1 for i in range(len(ticks))]   # low while there's a burst
+        edges.append((ticks, levels, (tick + post_us) & TICK_MASK))
+        tick = (start + max(GAP_US, sum(widths) + post_us + GAP_US // 2)) & TICK_MASK
+    return edges
+
+
+def run(edges, decoder_opts, tolerance, outputs=None):
+    """ Feed edges to a new IrReceiver and append the commands that came out of each
+        transmission to outputs, if there is one. Returns (wall s, CPU s).
+    """
+    rcvr = IrReceiver(ReplayPi(), **dict(decoder_opts, **{'--protocols': 'nec',
+                                                          '--tolerance': tolerance,
+                                                         }))
+    rcvr.look_for_a_code = True
+    rcvr.no_repeat = set()      # every repeat repeats, even mute
+    cbf = rcvr.cbf
+    pin = rcvr.pin_ir
+    pig = rcvr.pig
+    get_commands = rcvr.get_commands
+    t_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for ticks, levels, timeout_tick in edges:
+        for tick, level in zip(ticks, levels):
+            cbf(pin, level, tick)
+        if pig.watchdog_ms:
+            cbf(pin, pigpio.TIMEOUT, timeout_tick)
+        if outputs is None:
+            for _ in get_commands():
+                pass
+        else:
+            outputs.append(list(get_commands()))
+    return time.perf_counter() - t_start, time.process_time() - cpu_start
+
+
+def score(workload, outputs):
+    scores = dict.fromkeys(('correct', 'missed', 'wrong', 'junk'), 0)
+    for (_, expected), got in zip(workload, outputs):
+        if expected is None:
+            scores['junk'] += bool(got)
+        elif got == [expected]:
+            scores['correct'] += 1
+        elif not got:
+            scores['missed'] += 1
+        else:
+            scores['wrong'] += 1
+    return scores
+
+
+def benchmark(opts):
+    """ Every decoder at every tolerance over the same workload. Returns the results dict.
+        opts is a dict of command line options
+    """
+    params = {'frames': int(opts['--frames']),
+              'jitter_pct': float(opts['--jitter']),
+              'glitch_pct': float(opts['--glitches']),
+              'junk_pct': float(opts['--junk']),
+              'skew_pct': float(opts['--skew'] or 0),
+              'seed': int(opts['--seed']),
+              'start_tick': START_TICK}
+    workload = make_workload(params['frames'], params['jitter_pct'], params['glitch_pct'],
+                             params['junk_pct'], params['skew_pct'],
+                             random.Random(params['seed']))
+    edges = to_edges(workload, IrReceiver(ReplayPi()).post_ms * 1000)
+    n_codes = sum(1 for _, expected in workload if expected)
+
+    runs = []
+    for tolerance in [int(tol) for tol in opts['--tolerances'].split(',')]:
+        for decoder, decoder_opts in DECODERS:
+            outputs = []
+            wall_s, cpu_s = run(edges, decoder_opts, tolerance, outputs)
+            tracemalloc.start()     # a second pass, it slows everything down
+            run(edges, decoder_opts, tolerance)
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            scores = score(workload, outputs)
+            runs.append(dict(scores, decoder=decoder, tolerance=tolerance,
+                             frames_per_s=round(len(edges) / wall_s),
+                             cpu_us_per_frame=round(cpu_s * 1e6 / len(edges), 2),
+                             peak_kib=round(peak_bytes / 1024, 1),
+                             accuracy=round(scores['correct'] / n_codes, 4) if n_codes else 1.0))
+    return {'label': opts['--label'] or '',
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'params': params,
+            'runs': runs}
+
+
+def show(results, before=None):
+    """ Print the runs, with the matching run from before where there is one.
+    """
+    params = results['params']
+    print('%s %s, %d transmissions, jitter %g%%, glitches %g%%, junk %g%%, skew %g%%'%(
+        results['label'], results['time'], params['frames'], params['jitter_pct'],
+        params['glitch_pct'], params['junk_pct'], params.get('skew_pct', 0)))
+    old_runs = {}
+    if before:
+        print('  vs %s %s'%(before['label'], before['time']))
+        if before['params'] != results['params']:
+            print('  (different workload parameters)')
+        old_runs = {(run['decoder'], run['tolerance']): run for run in before['runs']}
+    print('  decoder   tol   frames/s    cpu us  peak KiB  accuracy  missed wrong junk')
+    for run in results['runs']:
+        print('  %-8s %4d %10d %9.2f %9.1f %9.4f %7d %5d %4d'%(
+            run['decoder'], run['tolerance'], run['frames_per_s'], run['cpu_us_per_frame'],
+            run['peak_kib'], run['accuracy'], run['missed'], run['wrong'], run['junk']))
+        old = old_runs.get((run['decoder'], run['tolerance']))
+        if old:
+            print('  %-13s %9.1f%% %8.1f%% %8.1f%% %9.4f'%(
+                'change', percent(old['frames_per_s'], run['frames_per_s']),
+                percent(old['cpu_us_per_frame'], run['cpu_us_per_frame']),
+                percent(old['peak_kib'], run['peak_kib']), run['accuracy'] - old['accuracy']))
+
+
+def percent(before, after):
+    return (after - before) * 100.0 / before if before else 0.0
+
+
+def main(opts):
+    """ opts is a dict of command line options
+    """
+    results = benchmark(opts)
+    before = None
+    if opts['--compare']:
+        with open(opts['--compare']) as f_in:
+            before = json.load(f_in)
+    show(results, before)
+    if opts['--out']:
+        with open(opts['--out'], 'w') as f_out:
+            json.dump(results, f_out, indent=1)
+
+
+if __name__ == '__main__':
+    import docopt
+    main(docopt.docopt(usage_text, version='0.0.3'))
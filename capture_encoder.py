@@ -3,9 +3,14 @@
 """
 
 import time
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import pigpio
 
+from log_sink import open_log
+from pig_batch import PigBatch
+from water_log import WaterLogWriter
+from water_flow import FlowAggregator
+
 
 class CaptureEncoder():
     """ A class to encapsulate the water meter: SPWM-075 from EKM Metering
@@ -15,6 +20,9 @@ class CaptureEncoder():
         Instantiate with a dict of options:
 
             opts = {'--file': '/home/pi/wet/waterlog.txt',
+                    '--binlog': '/home/pi/wet/waterlog.bin',  # optional, see water_log.py
+                    '--rollup': '/home/pi/wet/rollup.txt',    # optional, see water_flow.py
+                    '--leak': 120,         # optional, minutes of nonstop flow that is a leak
                     '--meter': 4           # J8-7
                     '--led': 15            # J8-10
                     '--heartbeat': 1.0
@@ -22,8 +30,25 @@ class CaptureEncoder():
                     '--debounce': 0.09
                    }
 
+        Meter changes are timed by the daemon's tick (us), not by when we got to them. A
+        (tick, UTC datetime) reference turns a tick into a time. The binary log and the
+        flow totals get UTC, only the text log is in local time. The tick wraps every 71.6
+        minutes, and the wall clock since the reference says how many times it has. The
+        reference is taken again every REF_S so the tick clock can't drift off.
+
+        Either call sample() continually from a main loop, or call start() once and the
+        meter is serviced from a pigpio edge callback (debounced by the daemon's glitch
+        filter) while the heartbeat LED runs as a script inside the daemon. Then the
+        process just sleeps between meter ticks. stop() undoes start().
+
+        self.flow keeps running minute/hour/day totals, the flow rate and a leak flag:
+            encoder.flow.flow_gpm(datetime.now()), encoder.flow.leak(datetime.now())
+
         todo: cleanup() can print total_ticks since self.time_start
     """
+    # p0 is the LED gpio, p1 the half period in ms
+    HEARTBEAT_SCRIPT = b'tag 100 w p0 1 mils p1 w p0 0 mils p1 jmp 100'
+    REF_S = 600.0
 
     def __init__(self, pig, opts):
         self.opts = opts
@@ -32,6 +57,9 @@ class CaptureEncoder():
         self.led_gpio = int(opts['--led'])
         self.led_period = float(opts['--heartbeat']) * 0.5  # led state changes each half period
         self.log_file_name = opts['--file']
+        self.log = open_log(self.log_file_name)    # buffered, written by log_sink's thread
+        self.bin_log = WaterLogWriter(opts['--binlog']) if opts.get('--binlog') else None
+        self.flow = FlowAggregator(opts.get('--rollup') or '', int(opts.get('--leak') or 120))
 
         self.pig.set_mode(self.led_gpio, pigpio.OUTPUT)
         self.pig.set_mode(self.meter_gpio, pigpio.INPUT)
@@ -40,18 +68,91 @@ class CaptureEncoder():
             hdw_ver = self.pig.get_hardware_revision()
             print('Wet found hardware ver %06x'%(hdw_ver))
             print('  and using GPIO%d and GPIO%d'%(self.meter_gpio, self.led_gpio))
-        self.meter_state = self.pig.input(self.meter_gpio)
-        self.time_start = self.time_meter = self.time_led = datetime.now()
+        self.meter_state = self.pig.read(self.meter_gpio)
+        self.led_state = self.pig.read(self.led_gpio)   # then we keep track of it ourselves
+        self.batch = PigBatch(self.pig)
+        self.time_start = self.time_meter = self.time_led = datetime.now(timezone.utc)
         self.total_ticks = 0
         self.time_debounce = float(opts['--debounce'])
+        self.tick_ref = (self.pig.get_current_tick(), datetime.now(timezone.utc))
+        self.meter_cb = None
+        self.heartbeat_id = None
+
+
+    def start(self, deliver=None):
+        """ Switch to callback mode. The glitch filter wants the meter level steady for
+            --debounce before it reports an edge, which replaces the debounce in sample().
+            deliver(func, gpio, level, tick) moves meter_cbf() off pigpio's thread,
+            e.g. an asyncio loop's call_soon_threadsafe.
+        """
+        debounce_us = min(int(self.time_debounce * 1e6), 300000)   # pigpio's max
+        self.pig.set_glitch_filter(self.meter_gpio, debounce_us)
+        self.meter_state = self.pig.read(self.meter_gpio)
+        self.tick_ref = (self.pig.get_current_tick(), datetime.now(timezone.utc))
+        cbf = self.meter_cbf
+        if deliver:
+            cbf = lambda gpio, level, tick: deliver(self.meter_cbf, gpio, level, tick)
+        self.meter_cb = self.pig.callback(self.meter_gpio, pigpio.EITHER_EDGE, cbf)
+
+        self.heartbeat_id = self.pig.store_script(CaptureEncoder.HEARTBEAT_SCRIPT)
+        while self.pig.script_status(self.heartbeat_id)[0] == pigpio.PI_SCRIPT_INITING:
+            time.sleep(0.01)
+        self.pig.run_script(self.heartbeat_id, [self.led_gpio, int(self.led_period * 1000)])
+
+
+    def stop(self):
+        """ Back to polling mode: drop the callback, the glitch filter and the heartbeat.
+        """
+        if self.meter_cb:
+            self.meter_cb.cancel()
+            self.meter_cb = None
+            self.pig.set_glitch_filter(self.meter_gpio, 0)
+        if self.heartbeat_id is not None:
+            self.pig.stop_script(self.heartbeat_id)
+            self.pig.delete_script(self.heartbeat_id)
+            self.heartbeat_id = None
+
+
+    def meter_cbf(self, gpio, level, tick):
+        """ pigpio calls this for each debounced meter edge. It's logged at the edge's
+            tick so the time between meter changes doesn't depend on how late we were called.
+        """
+        if level == pigpio.TIMEOUT or level == self.meter_state:
+            return
+        self.meter_state = level
+        self.record(level, self.tick_time(tick))
+        if self.time_difference(self.tick_ref[1], datetime.now(timezone.utc)) > \
+           CaptureEncoder.REF_S:
+            self.tick_ref = (self.pig.get_current_tick(), datetime.now(timezone.utc))
+
+
+    def tick_time(self, tick):
+        """ The datetime of a pigpio tick.
+        """
+        ref_tick, ref_time = self.tick_ref
+        diff_us = (tick - ref_tick) & 0xFFFFFFFF
+        wall_us = (datetime.now(timezone.utc) - ref_time).total_seconds() * 1e6
+        wraps = max(round((wall_us - diff_us) / 2**32), 0)
+        return ref_time + timedelta(microseconds=diff_us + wraps * 2**32)
+
+
+    def record(self, meter_now, time_now):
+        """ Count a meter change and log its time.
+        """
+        if self.opts['--verbose']:
+            print(meter_now, end='')
+        self.time_meter = time_now
+        self.total_ticks += 1
+        self.log.write(time_now.astimezone().strftime('%y-%m-%d %H:%M:%S.%f'))
+        if self.bin_log:
+            self.bin_log.append(time_now)
+        self.flow.add(time_now)
 
 
     def time_difference(self, prev, nxt):
         """ return the difference between 2 timestamps down to the the microsecond
         """
-        diff_time = time.mktime(nxt.timetuple()) + nxt.microsecond*1e-6 -\
-                    time.mktime(prev.timetuple()) + prev.microsecond*1e-6
-        return diff_time
+        return (nxt - prev).total_seconds()
 
 
     def sample(self):
@@ -61,14 +162,20 @@ class CaptureEncoder():
             The file is read by some other python scripts to display the water usage
             in various ways.
         """
-        meter_now = self.pig.input(self.meter_gpio)
-        time_now = datetime.now()
+        time_now = datetime.now(timezone.utc)
+        if self.time_difference(self.tick_ref[1], time_now) > CaptureEncoder.REF_S:
+            self.tick_ref = (self.pig.get_current_tick(), datetime.now(timezone.utc))
 
-        # flash the LED on a 1 Hz schedule
+        # flash the LED on a 1 Hz schedule. Batched with the meter read and the tick the
+        # read happened at: one round trip
         if self.time_difference(self.time_led, time_now) > self.led_period:
             self.time_led = time_now
-            led_state_next = 0 if self.pig.read(self.led_gpio) else 1
-            self.pig.write(self.led_gpio, led_state_next)
+            self.led_state = 0 if self.led_state else 1
+            self.batch.write(self.led_gpio, self.led_state)
+        self.batch.read(self.meter_gpio)
+        self.batch.get_current_tick()
+        meter_now, tick = self.batch.run()[-2:]
+        time_now = self.tick_time(tick)
 
         """ The reed switch in the SPWM-075 doesn't seem to bounce much, but I limit
             the maximum transition rate here just in case. Using 0.09 sec debounce, the max
@@ -79,10 +186,5 @@ class CaptureEncoder():
         # after a debounce period, check if the water meter state changed
         if self.time_difference(self.time_meter, time_now) > self.time_debounce:
             if self.meter_state != meter_now:
-                if self.opts['--verbose']:
-                    print(meter_now, end='')
                 self.meter_state = meter_now
-                self.time_meter = meter_now
-                self.total_ticks += 1
-                with open(self.log_file_name, 'a') as fout:
-                    fout.write('%s\n' % time_now.strftime('%y-%m-%d %H:%M:%S.%f'))
+                self.record(meter_now, time_now)
@@ -0,0 +1,184 @@
+# cb_profile.py
+# opt-in profiling for a pigpio callback (IrReceiver --profile)
+"""Notes:
+    pigpio calls IrReceiver.cbf() from one thread in the pigpio module that reads edge
+    reports off the daemon's notification socket. If cbf() is slow the reports back up
+    in the socket and everything downstream is late. This measures three things for
+    every call:
+
+        run time        perf_counter() around the call
+        off CPU         run time minus thread_time() for the call: time the thread was
+                        runnable but not running. In practice that's waiting for the GIL
+                        (or a blocking write)
+        backlog         how late the call is compared to the edge's daemon tick. The two
+                        clocks aren't the same so we keep the smallest offset seen as the
+                        baseline; backlog is how far this call is past it
+
+    The histograms are pipe_stats ones so they're scraped with everything else.
+
+    With --bulk there's no per edge callback. IrReceiver.edges() and timeout_event() are
+    wrapped instead, so a call is a whole run of edges and its backlog is the last one's.
+
+    A sampler thread looks at the callback every --slow/2 us and if a call has been
+    running longer than --slow it records that thread's stack. dump() (and SIGUSR1)
+    write the histograms and the most common slow stacks to the --profile file.
+"""
+
+import collections
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import pipe_stats
+
+MAX_STACKS = 100            # distinct slow stacks kept, the rest are just counted
+TICK_WRAP = 1 << 32
+
+
+class CallbackProfiler():
+    """ Wrap a pigpio callback function and profile each call.
+            profiler = CallbackProfiler('/tmp/cbf.txt', slow_us=1000)
+            pig.callback(pin, pigpio.EITHER_EDGE, profiler.wrap(self.cbf))
+    """
+
+    def __init__(self, file_name, slow_us=1000, signum=signal.SIGUSR1):
+        self.file_name = file_name
+        self.slow_us = slow_us
+        self.run_hist = pipe_stats.histogram('ir_cbf_seconds', 'IR callback run time')
+        self.off_cpu_hist = pipe_stats.histogram('ir_cbf_off_cpu_seconds',
+                                                 'IR callback time not on the CPU (GIL wait)')
+        self.backlog_hist = pipe_stats.histogram('ir_cbf_backlog_seconds',
+                                                 'IR callback lateness vs the edge tick')
+        self.n_calls = 0
+        self.max_us = 0
+        self.base_offset = None     # smallest (our clock - daemon tick) seen, mod 2**32
+        self.call_start = 0         # perf_counter() of the call in progress, 0 if idle
+        self.thread_id = None       # pigpio's callback thread, see watch()
+        self.stacks = collections.Counter()
+        self.other_stacks = 0
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample_loop, name='cb_profile', daemon=True)
+        self.sampler.start()
+        if signum:
+            try:
+                signal.signal(signum, lambda signum, frame: self.dump())
+            except ValueError:      # only the main thread can set handlers
+                print('cb_profile: no signal handler, call dump() yourself')
+
+
+    def watch(self, thread):
+        """ The thread the callback runs on, so the sampler can look at it before the
+            first call. Otherwise the first call tells us.
+        """
+        if thread is not None and thread.ident is not None:
+            self.thread_id = thread.ident
+
+
+    def wrap(self, func):
+        """ Return a pigpio callback that profiles func.
+        """
+        return self.timed(func, lambda gpio, level, tick: tick)
+
+
+    def wrap_edges(self, func):
+        """ Profile IrReceiver.edges(ticks, levels), the --bulk entry point.
+        """
+        return self.timed(func, lambda ticks, levels: ticks[-1])
+
+
+    def wrap_timeout(self, func):
+        """ Profile IrReceiver.timeout_event(tick).
+        """
+        return self.timed(func, lambda tick: tick)
+
+
+    def timed(self, func, tick_of):
+        """ func, profiled. tick_of(*args) is the daemon tick the call is for.
+        """
+        def profiled(*args):
+            t_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            self.call_start = t_start
+            try:
+                return func(*args)
+            finally:
+                self.call_start = 0
+                self.record(tick_of(*args), t_start, time.perf_counter() - t_start,
+                            time.thread_time() - cpu_start)
+        return profiled
+
+
+    def record(self, tick, t_start, run_s, cpu_s):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self.n_calls += 1
+        run_us = run_s * 1e6
+        self.max_us = max(self.max_us, run_us)
+        self.run_hist.observe(run_us)
+        self.off_cpu_hist.observe(max(run_us - cpu_s * 1e6, 0))
+
+        offset = (int(t_start * 1e6) - tick) % TICK_WRAP
+        if self.base_offset is None:
+            self.base_offset = offset
+        backlog = (offset - self.base_offset) % TICK_WRAP
+        if backlog >= TICK_WRAP // 2:       # earlier than the baseline: new baseline
+            self.base_offset = offset
+            backlog = 0
+        self.backlog_hist.observe(backlog)
+
+
+    def sample_loop(self):
+        """ Grab the callback thread's stack while a call is over --slow.
+        """
+        period = max(self.slow_us * 0.5e-6, 0.0001)
+        while self.running:
+            time.sleep(period)
+            call_start = self.call_start
+            if not call_start or (time.perf_counter() - call_start) * 1e6 < self.slow_us:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = tuple('%s:%d %s'%(f_sum.filename, f_sum.lineno, f_sum.name)
+                          for f_sum in traceback.extract_stack(frame))
+            if stack in self.stacks or len(self.stacks) < MAX_STACKS:
+                self.stacks[stack] += 1
+            else:
+                self.other_stacks += 1
+
+
+    def close(self):
+        self.running = False
+
+
+    def report(self):
+        """ The profile as text.
+        """
+        lines = ['callback profile: %d calls, longest %.0f us, slow is over %d us'%(
+            self.n_calls, self.max_us, self.slow_us)]
+        for hist in (self.run_hist, self.off_cpu_hist, self.backlog_hist):
+            lines.append('')
+            lines.append('%s (%s), %d calls, mean %.1f us'%(
+                hist.name, hist.help_text, hist.n_observed,
+                hist.sum_us / hist.n_observed if hist.n_observed else 0))
+            for bound_us, count in zip(hist.bounds_us + ('more',), hist.counts):
+                if count:
+                    lines.append('  <= %-8s %d'%(bound_us, count))
+        lines.append('')
+        lines.append('slow stacks, sampled every %d us while a call was running long:'%(
+            self.slow_us // 2,))
+        for stack, count in self.stacks.most_common():
+            lines.append('  %d samples'%(count,))
+            lines.extend('    ' + frame for frame in stack)
+        if self.other_stacks:
+            lines.append('  %d more samples in other stacks'%(self.other_stacks,))
+        return '\n'.join(lines) + '\n'
+
+
+    def dump(self):
+        """ Write report() to the --profile file.
+        """
+        with open(self.file_name, 'w') as fout:
+            fout.write(self.report())
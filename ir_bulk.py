@@ -0,0 +1,130 @@
+# ir_bulk.py
+# feed IrReceiver from a pigpio notification pipe in batches (ir_rx --bulk)
+"""Notes:
+    Normally pigpio's Python library reads the daemon's edge reports and calls
+    IrReceiver.cbf() once per edge. With --bulk we open our own notification handle on
+    the IR gpio and read its pipe, /dev/pigpio<handle>, directly. When the pin is busy
+    one read() returns many reports, so one Python call handles a whole burst of edges.
+
+    Each report is 12 bytes, little endian:
+        H seqno     counts up by one per report, so a jump means the daemon dropped some
+        H flags     0 for an edge, else watchdog (| the gpio), keep alive or event
+        I tick      us
+        I level     all the gpio levels after the edge
+    We cast a read straight to uint32 words and pull out every tick and level with a
+    slice. Runs of plain edges go to IrReceiver.edges(); watchdog reports go to
+    IrReceiver.timeout_event() in between, so the order is kept.
+
+    The pipe only exists on the pi running pigpiod.
+"""
+
+import sys
+import threading
+
+import pigpio
+
+import pipe_stats
+
+RECORD_BYTES = 12
+READ_RECORDS = 1024          # the most reports one read() picks up
+
+assert sys.byteorder == 'little'     # we cast the pipe's bytes straight to uint32
+
+
+class BulkEdges():
+    """ Read the IR pin's notification pipe on a thread and pass the edges to rcvr.
+        cancel() stops it, like a pigpio callback. edges and timeout_event stand in for
+        rcvr's, e.g. profiled ones.
+    """
+
+    def __init__(self, pig, rcvr, edges=None, timeout_event=None):
+        self.pig = pig
+        self.rcvr = rcvr
+        self.edges = edges or rcvr.edges
+        self.timeout_event = timeout_event or rcvr.timeout_event
+        self.bit = 1 << rcvr.pin_ir
+        self.seqno = None       # of the last report
+        self.dropped = 0        # reports the daemon lost (seqno jumps)
+        self.reads = 0
+        self.records = 0
+        self.handle = pig.notify_open()
+        if self.handle < 0:
+            raise pigpio.error(pigpio.error_text(self.handle))
+        self.pipe = open('/dev/pigpio%d'%(self.handle,), 'rb', buffering=0)
+        self.running = True
+        self.thread = threading.Thread(target=self.read_loop, name='ir_bulk', daemon=True)
+        self.thread.start()
+        pig.notify_begin(self.handle, self.bit)
+        pipe_stats.add_collector(self.collect_stats)
+
+
+    def read_loop(self):
+        leftover = b''
+        while self.running:
+            try:
+                data = self.pipe.read(RECORD_BYTES * READ_RECORDS)
+            except (OSError, ValueError):   # closed by cancel()
+                return
+            if not data:
+                return
+            if leftover:
+                data = leftover + data
+            n_bytes = len(data) - len(data) % RECORD_BYTES
+            leftover = data[n_bytes:]
+            if n_bytes:
+                self.batch(memoryview(data)[:n_bytes].cast('I'))
+
+
+    def batch(self, words):
+        """ Handle a read's worth of reports, as a memoryview of uint32 words.
+        """
+        heads = words[0::3].tolist()    # seqno | flags << 16
+        ticks = words[1::3].tolist()
+        levels = words[2::3].tolist()
+        self.reads += 1
+        self.records += len(heads)
+
+        first_seqno = heads[0] & 0xFFFF
+        if self.seqno is not None:
+            self.dropped += (first_seqno - self.seqno - 1) & 0xFFFF
+        self.seqno = heads[-1] & 0xFFFF
+        self.dropped += (self.seqno - first_seqno - len(heads) + 1) & 0xFFFF
+
+        bit = self.bit
+        edges = self.edges
+        if max(heads) <= 0xFFFF:        # no flags anywhere, just edges. The usual case
+            edges(ticks, [level & bit for level in levels])
+            return
+        start = 0
+        for i, head in enumerate(heads):
+            flags = head >> 16
+            if not flags:
+                continue
+            if i > start:
+                edges(ticks[start:i], [level & bit for level in levels[start:i]])
+            if flags & pigpio.NTFY_FLAGS_WDOG:
+                self.timeout_event(ticks[i])
+            start = i + 1
+        if start < len(heads):
+            edges(ticks[start:], [level & bit for level in levels[start:]])
+
+
+    def cancel(self):
+        """ Stop reading and give the handle back to the daemon.
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.pig.notify_close(self.handle)      # the read() sees end of file
+        self.thread.join(1.0)
+        self.pipe.close()
+
+
+    def collect_stats(self):
+        pin = 'pin="%d"'%(self.rcvr.pin_ir,)
+        return [('ir_bulk_reads_total', 'counter', 'Notification pipe reads',
+                 [(pin, self.reads)]),
+                ('ir_bulk_records_total', 'counter', 'Notification reports read',
+                 [(pin, self.records)]),
+                ('ir_bulk_dropped_total', 'counter', 'Notification reports the daemon lost',
+                 [(pin, self.dropped)])]
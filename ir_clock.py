@@ -0,0 +1,118 @@
+# ir_clock.py
+# recover a remote's clock from its preamble (IrReceiver --adaptive)
+"""Notes:
+    The protocol windows are nominal timing +- --tolerance. A remote whose clock runs
+    slow or fast (weak batteries, a cheap resonator, cold) stretches or squeezes every
+    width by the same factor. A few percent eats most of the tolerance and jitter does
+    the rest, so frames get thrown out as 'bad spaces' and you press the key again.
+
+    A transmission that fails at nominal timing gets another try, with its widths
+    divided by a timing scale:
+        the preamble's    (burst + space) / nominal. The preamble is the longest thing
+                          in the frame, so it measures the clock best. The burst and
+                          space must each still fit within --tolerance once scaled, and
+                          the scale within ACQUIRE_PCT of 1
+        a remote's        what that remote's frames have measured before, its profile.
+                          Helps when the preamble itself took a hit
+    The bits are then decoded against the normal windows, so a rescued frame passes
+    the same checks as any other.
+
+    Profiles are kept per (protocol, address), a running average over about
+    PROFILE_FRAMES good codes. A code's scale is measured from the whole frame (its
+    length against the protocol's nominal() length) where the protocol has one, else
+    from the preamble. A frame at nominal timing from a remote without a profile has
+    nothing to teach and doesn't start one. pipe_stats shows them as
+    ir_remote_timing_scale.
+
+    Frames that decode at nominal timing decode as before, then cost a sum and a
+    popcount to measure. --stream can't go back,
+    so it keeps the widths as well and a frame step() gave up on is retried when it ends
+    (the --post timeout). A rescue costs that much latency, a key press costs more.
+"""
+
+ACQUIRE_PCT = 30        # the furthest off nominal a remote's clock can be
+PROFILE_FRAMES = 16     # frames in a profile's running average
+SAME_SCALE = 0.002      # scales closer than this are the same try
+
+
+class ClockRecovery():
+    """ Timing scales to retry a failed transmission with, and the per remote profiles.
+    """
+
+    def __init__(self):
+        self.preambles = []     # (protocol, nominal burst us, nominal space us)
+        self.by_name = {}
+        self.tolerance = 0.0
+        self.profiles = {}      # (protocol name, address) -> [scale, frames]
+        self.rescued = 0        # transmissions that only decoded with a scale
+
+
+    def compile(self, protocols, tolerance_pct):
+        """ Take the nominal preambles from IrReceiver's compiled protocols: the middle
+            of each window. Profiles are kept.
+        """
+        self.tolerance = tolerance_pct * 0.01
+        self.by_name = {proto.name: proto for proto in protocols}
+        self.preambles = []
+        for proto in protocols:
+            for (lo_m, hi_m), (lo_s, hi_s) in proto.preambles():
+                self.preambles.append((proto, (lo_m + hi_m) * 0.5, (lo_s + hi_s) * 0.5))
+
+
+    def scales(self, protocols, mark, space):
+        """ The timing scales worth trying for a transmission in protocols that starts
+            with a mark us burst and a space us space. Best guesses first.
+        """
+        found = []
+        tolerance = self.tolerance
+        for proto, nom_mark, nom_space in self.preambles:
+            if proto not in protocols:
+                continue
+            scale = (mark + space) / (nom_mark + nom_space)
+            if abs(scale - 1.0) * 100 > ACQUIRE_PCT:
+                continue
+            if abs(mark / (scale * nom_mark) - 1.0) > tolerance or \
+               abs(space / (scale * nom_space) - 1.0) > tolerance:
+                continue
+            if all(abs(scale - other) > SAME_SCALE for other in found):
+                found.append(scale)
+        for scale, _ in sorted(self.profiles.values(), key=lambda profile: -profile[1]):
+            if all(abs(scale - other) > SAME_SCALE for other in found):
+                found.append(scale)
+        return found
+
+
+    def preamble_scale(self, proto, mark, space):
+        """ The scale of a preamble that proto accepted.
+        """
+        return min(((mark + space) / (nom_mark + nom_space)
+                    for other, nom_mark, nom_space in self.preambles if other is proto),
+                   key=lambda scale: abs(scale - 1.0), default=1.0)
+
+
+    def measure(self, name, address, command, a_code):
+        """ The scale of a whole good code, from its length against what encode() makes.
+        """
+        proto = self.by_name[name]
+        if not hasattr(proto, 'nominal'):
+            return self.preamble_scale(proto, a_code[0], a_code[1])
+        n_edges, nominal_us = proto.nominal(address, command)
+        return sum(a_code[:n_edges]) / nominal_us
+
+
+    def learn(self, name, address, scale):
+        profile = self.profiles.get((name, address))
+        if profile is None:
+            if abs(scale - 1.0) <= SAME_SCALE:
+                return          # at nominal timing, the windows already fit it
+            profile = self.profiles[(name, address)] = [scale, 0]
+        profile[1] += 1
+        profile[0] += (scale - profile[0]) / min(profile[1], PROFILE_FRAMES)
+
+
+    def collect_stats(self, pin):
+        return [('ir_rescued_total', 'counter', 'Transmissions only decoded with a timing scale',
+                 [(pin, self.rescued)]),
+                ('ir_remote_timing_scale', 'gauge', 'Remote clock, 1.0 is nominal timing',
+                 [('%s,protocol="%s",address="%d"'%(pin, name, address), round(profile[0], 4))
+                  for (name, address), profile in sorted(self.profiles.items())])]
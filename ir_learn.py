@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""ir_learn.py
+   Work out an unknown remote's timing from --raw captures and print an ir_protocols
+   class for it.
+
+   Capture with `ir_rx.py --raw learn.txt --protocols rc6` (any protocol the remote
+   doesn't speak, so nothing decodes and every transmission is kept) and press its
+   keys a while, each a few times and some held down. Then on any machine with NumPy
+   (the pi doesn't need it):
+        ./ir_learn.py learn.txt learn.txt.1 ...
+
+   The files are split into chunks that a pool of processes parse into NumPy arrays,
+   so a few hundred thousand frames take seconds. Then:
+        frame lengths   the most common edge count is the code, a short one that starts
+                        with the same burst is the repeat code
+        preamble        the median of the code's first two widths, and of the repeat's
+        clusters        a log spaced histogram of the data bursts and of the data spaces
+                        finds the peaks, a 1-D k-means from them finds the centres
+        encoding        one burst width, two space widths: pulse distance (NEC family)
+                        two burst widths, one space width: pulse width (Sony)
+                        bursts and spaces both T and 2T: bi-phase (RC-5/6)
+        byte rules      for 32 bit pulse distance codes, the strictest check() of nec,
+                        samsung and nec-ext that nearly every code passes
+
+   The template subclasses the protocol it is most like, so a pulse distance remote
+   with 32 bits decodes as soon as the class is pasted into ir_protocols.py and
+   registered. Anything else gets its timing measured and a note of what's missing.
+
+   Widths are named the ir_protocols way: space_us is the burst before each data bit,
+   zero_us and one_us the space after it.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import numpy as np
+
+from ir_protocols import PROTOCOLS
+
+usage_text = """
+ Usage:
+  ir_learn  [--jobs <J>] [--chunk <C>] [--bins <B>] [--name <N>] [--out <O>] [--verbose] <R>...
+  ir_learn -h | --help
+
+ Options:
+  -h --help               Show this screen.
+  -j --jobs <J>           Processes to parse with, 0 for one per CPU [default: 0]
+  -c --chunk <C>          MB of capture per parse job [default: 4]
+  -b --bins <B>           Histogram bins [default: 200]
+  -n --name <N>           Name of the new protocol [default: learned]
+  -o --out <O>            Write the template to this file as well
+  -v --verbose            Print the clusters and frame lengths
+    """
+
+MIN_PEAK = 0.002        # a histogram peak needs this fraction of the widths per bin
+MAX_CLUSTERS = 6
+KMEANS_ROUNDS = 20
+RULE_PASS = 0.95        # fraction of codes a byte rule must pass to be the remote's
+REPEAT_EDGES = 3        # burst, space, burst
+MIN_REPEATS = 0.05      # fewer repeats a code than this is junk, no repeat code
+NEAR = 0.25             # widths this close (fraction) are the same thing
+
+
+def chunks(file_name, chunk_bytes):
+    """ Split a capture file into (file_name, start, end) byte ranges on line ends.
+    """
+    size = os.path.getsize(file_name)
+    jobs = []
+    start = 0
+    with open(file_name, 'rb') as f_in:
+        while start < size:
+            end = min(start + chunk_bytes, size)
+            if end < size:
+                f_in.seek(end)
+                end += len(f_in.readline())
+            jobs.append((file_name, start, end))
+            start = end
+    return jobs
+
+
+def load_chunk(job):
+    """ Parse one chunk of a --raw capture, the way ir_rx.read_raw() does.
+        Returns (widths, lengths): every frame's widths end to end and the edge count
+        of each frame.
+    """
+    file_name, start, end = job
+    with open(file_name, 'rb') as f_in:
+        f_in.seek(start)
+        text = f_in.read(end - start).decode('ascii')
+    lines = [line for line in (line.strip() for line in text.split('\n'))
+             if line and line[0] != '#']
+    if not lines:
+        return np.zeros(0, np.int32), np.zeros(0, np.int32)
+    n_fields = np.fromiter((line.count(',') + 1 for line in lines), np.int64, len(lines))
+    flat = np.fromstring(','.join(lines), dtype=np.int64, sep=',')
+    if len(flat) != n_fields.sum():
+        raise ValueError('%s: bad line between bytes %d and %d'%(file_name, start, end))
+    firsts = np.cumsum(n_fields) - n_fields     # where each line's n_edges is
+    lengths = np.clip(np.minimum(flat[firsts], n_fields - 1), 0, None)
+    # the widths of line i are flat[firsts[i] + 1 : firsts[i] + 1 + lengths[i]]
+    starts = np.cumsum(lengths) - lengths
+    index = np.arange(lengths.sum()) + np.repeat(firsts + 1 - starts, lengths)
+    return flat[index].astype(np.int32), lengths.astype(np.int32)
+
+
+def load(file_names, jobs=0, chunk_mb=4):
+    """ Load --raw captures in a process pool. Returns (widths, lengths, offsets) where
+        frame i is widths[offsets[i]:offsets[i] + lengths[i]].
+    """
+    work = []
+    for file_name in file_names:
+        work += chunks(file_name, max(int(chunk_mb * 1000000), 1))
+    with ProcessPoolExecutor(max_workers=jobs or None) as pool:
+        parts = list(pool.map(load_chunk, work))
+    widths = np.concatenate([part[0] for part in parts] or [np.zeros(0, np.int32)])
+    lengths = np.concatenate([part[1] for part in parts] or [np.zeros(0, np.int32)])
+    offsets = np.cumsum(lengths) - lengths
+    return widths, lengths, offsets
+
+
+def frames_of(widths, offsets, length):
+    """ The frames starting at offsets that are length edges long, as a 2-D array.
+    """
+    return widths[offsets[:, None] + np.arange(length)[None, :]]
+
+
+def clusters(widths, bins=200):
+    """ Group widths in us: histogram peaks seed a 1-D k-means.
+        Returns [(centre us, share of the widths, spread)] by centre, spread being the
+        standard deviation over the centre.
+    """
+    values = widths.astype(np.float64)
+    if not len(values):
+        return []
+    lo, hi = max(values.min(), 1.0), max(values.max(), 2.0)
+    edges = np.geomspace(lo, hi * 1.0001, bins + 1)
+    counts = np.histogram(values, edges)[0].astype(np.float64)
+    smooth = np.convolve(counts, [1.0, 2.0, 1.0], 'same')
+    padded = np.concatenate(([-1.0], smooth, [-1.0]))
+    peaks = np.nonzero((smooth > padded[:-2]) & (smooth >= padded[2:]) &
+                       (smooth >= MIN_PEAK * 4 * len(values)))[0]
+    if not len(peaks):
+        peaks = np.array([int(np.argmax(smooth))])
+    seeds = []      # the tallest peaks, one per NEAR of width: jitter makes bumps
+    for peak in peaks[np.argsort(-smooth[peaks])]:
+        centre = np.sqrt(edges[peak] * edges[peak + 1])
+        if len(seeds) < MAX_CLUSTERS and not any(near(centre, seed) for seed in seeds):
+            seeds.append(centre)
+    centres = np.sort(np.array(seeds))
+
+    for _ in range(KMEANS_ROUNDS):
+        labels = np.searchsorted((centres[:-1] + centres[1:]) * 0.5, values)
+        n_in = np.bincount(labels, minlength=len(centres))
+        sums = np.bincount(labels, weights=values, minlength=len(centres))
+        keep = n_in > 0
+        moved = sums[keep] / n_in[keep]
+        if len(moved) == len(centres) and np.allclose(moved, centres, rtol=1e-4):
+            break
+        centres = moved
+    labels = np.searchsorted((centres[:-1] + centres[1:]) * 0.5, values)
+    n_in = np.bincount(labels, minlength=len(centres))
+    squares = np.bincount(labels, weights=(values - centres[labels]) ** 2,
+                          minlength=len(centres))
+    return [(centre, n / len(values), np.sqrt(sq / n) / centre if n else 0.0)
+            for centre, n, sq in zip(centres, n_in, squares)]
+
+
+def main_clusters(found, share=0.05):
+    """ The clusters with more than share of the widths: the rest is glitches.
+    """
+    return [cluster for cluster in found if cluster[1] >= share]
+
+
+def near(a_us, b_us):
+    return abs(a_us - b_us) <= NEAR * min(a_us, b_us)
+
+
+def byte_rule(spaces, zero_us, one_us):
+    """ The data bits of 32 bit pulse distance codes, lsb first, and the name of the
+        strictest NEC family check() that RULE_PASS of them pass (None for none).
+    """
+    values = (spaces[:, :32] > (zero_us + one_us) * 0.5).astype(np.int64) @ \
+             (np.int64(1) << np.arange(32, dtype=np.int64))
+    folded = values ^ (values >> 8)
+    passes = {'nec': (folded & 0x00FF00FF) == 0x00FF00FF,
+              'samsung': ((folded & 0xFF) == 0) & ((folded & 0x00FF0000) == 0x00FF0000),
+              'nec-ext': (folded & 0x00FF0000) == 0x00FF0000}
+    for name in ('nec', 'samsung', 'nec-ext'):
+        if passes[name].mean() >= RULE_PASS:
+            return values, name
+    return values, None
+
+
+def analyze(widths, lengths, offsets, bins=200):
+    """ Infer the protocol. Returns a dict of what was found, the us values rounded.
+    """
+    found = {'frames': len(lengths), 'widths': len(widths)}
+    if not len(lengths):
+        return found
+    by_length = np.bincount(lengths)
+    found['lengths'] = [(int(n), int(by_length[n])) for n in np.argsort(-by_length)[:8]
+                        if by_length[n]]
+    n_edges = int(np.argmax(by_length[REPEAT_EDGES + 1:]) + REPEAT_EDGES + 1) \
+        if len(by_length) > REPEAT_EDGES + 1 else int(np.argmax(by_length))
+    found['n_edges'] = n_edges
+    codes = frames_of(widths, offsets[lengths == n_edges], n_edges)
+    found['codes'] = len(codes)
+    pre_mark, pre_space = np.median(codes[:, 0]), np.median(codes[:, 1])
+    found['pre_mark_us'], found['pre_space_us'] = int(round(pre_mark)), int(round(pre_space))
+
+    if len(by_length) > REPEAT_EDGES:
+        repeats = frames_of(widths, offsets[lengths == REPEAT_EDGES], REPEAT_EDGES)
+        repeats = repeats[np.abs(repeats[:, 0] - pre_mark) <= NEAR * pre_mark]
+        if len(repeats) >= MIN_REPEATS * len(codes):
+            found['repeats'] = len(repeats)
+            found['rpt_space_us'] = int(round(np.median(repeats[:, 1])))
+            found['rpt_burst_us'] = int(round(np.median(repeats[:, 2])))
+
+    bursts = codes[:, 2::2]     # the data bursts and the stop burst
+    spaces = codes[:, 3::2]
+    found['burst_clusters'] = clusters(bursts.ravel(), bins)
+    found['space_clusters'] = clusters(spaces.ravel(), bins)
+    burst_c = [c[0] for c in main_clusters(found['burst_clusters'])]
+    space_c = [c[0] for c in main_clusters(found['space_clusters'])]
+
+    found['encoding'] = 'unknown'
+    if len(burst_c) == 1 and len(space_c) == 2:
+        found['encoding'] = 'pulse distance'
+        found['bits'] = spaces.shape[1]
+        found['space_us'] = int(round(burst_c[0]))
+        found['zero_us'], found['one_us'] = [int(round(c)) for c in space_c]
+        if found['bits'] == 32:
+            values, found['rule'] = byte_rule(spaces, space_c[0], space_c[1])
+            found['addresses'] = len(np.unique(values & 0xFFFF))
+            found['commands'] = len(np.unique((values >> 16) & 0xFF))
+    elif len(burst_c) == 2 and len(space_c) == 1:
+        found['encoding'] = 'pulse width'
+        found['bits'] = bursts.shape[1] - 1
+        found['space_us'] = int(round(space_c[0]))
+        found['zero_us'], found['one_us'] = [int(round(c)) for c in burst_c]
+    elif len(burst_c) in (1, 2) and len(space_c) in (1, 2):
+        half = min(burst_c + space_c)
+        if all(near(c, half) or near(c, 2 * half) for c in burst_c + space_c):
+            found['encoding'] = 'bi-phase'
+            found['half_us'] = int(round(half))
+    return found
+
+
+def template(found, name='learned'):
+    """ Python source of an ir_protocols class with the timing in found.
+    """
+    class_name = ''.join(part.capitalize() for part in name.replace('-', '_').split('_'))
+    lines = []
+    notes = []
+    if found.get('encoding') == 'pulse distance' and found.get('bits') == 32:
+        base = {'nec': 'Nec', 'samsung': 'Samsung', 'nec-ext': 'NecExt'}.get(found['rule'], 'Nec')
+        if not found['rule']:
+            notes.append('No NEC family byte rule fits, so check() keeps all 32 bits.')
+    elif found.get('encoding') == 'bi-phase':
+        base = 'Rc5'
+        notes.append('Bi-phase. Check the start bits and bit count against Rc5 and Rc6.')
+    else:
+        base = 'Nec'
+        notes.append('%s, %s bits: not something Nec.decode() can read, it needs its own.'%(
+            found.get('encoding'), found.get('bits', '?')))
+    lines.append('class %s(%s):'%(class_name, base))
+    lines.append('    """ Learned by ir_learn.py from %d codes of %d edges.'%(
+        found.get('codes', 0), found.get('n_edges', 0)))
+    for note in notes:
+        lines.append('        %s'%(note,))
+    lines.append('    """')
+    lines.append("    name = '%s'"%(name,))
+    if base == 'Rc5':
+        lines.append('    half_us = %d'%(found['half_us'],))
+    else:
+        for key in ('pre_mark_us', 'pre_space_us'):
+            lines.append('    %s = %d'%(key, found[key]))
+        if 'rpt_space_us' in found:
+            lines.append('    rpt_space_us = %d'%(found['rpt_space_us'],))
+            lines.append('    rpt_burst_us = %d'%(found['rpt_burst_us'],))
+        else:
+            lines.append('    rpt_space_us = None')
+        for key in ('space_us', 'zero_us', 'one_us'):
+            if key in found:
+                lines.append('    %s = %d'%(key, found[key]))
+        if base == 'Nec' and found.get('encoding') == 'pulse distance' and \
+           found.get('bits') == 32 and not found.get('rule'):
+            lines.append('')
+            lines.append('    def check(self, value):')
+            lines.append('        return value & 0xFFFF, value >> 16')
+    lines.append('')
+    lines.append('')
+    lines.append('register(%s)'%(class_name,))
+    return '\n'.join(lines) + '\n'
+
+
+def report(found, verbose=False):
+    """ Print what analyze() found.
+    """
+    print('%d frames, %d widths'%(found['frames'], found['widths']))
+    if not found['frames']:
+        return
+    print('edges per frame (count): %s'%(
+        ', '.join('%d (%d)'%length for length in found['lengths'][:verbose and 8 or 3]),))
+    print('code: %d edges, %d frames, preamble %d us burst %d us space'%(
+        found['n_edges'], found['codes'], found['pre_mark_us'], found['pre_space_us']))
+    if 'rpt_space_us' in found:
+        print('repeat: %d frames, %d us burst %d us space %d us burst'%(
+            found['repeats'], found['pre_mark_us'], found['rpt_space_us'],
+            found['rpt_burst_us']))
+    for what in ('burst', 'space'):
+        found_c = found['%s_clusters'%(what,)]
+        shown = found_c if verbose else main_clusters(found_c)
+        print('data %ss: %s'%(what, ', '.join('%d us %.0f%% +-%.0f%%'%(
+            centre, share * 100, spread * 100) for centre, share, spread in shown)))
+    print('encoding: %s%s'%(found['encoding'],
+                            ', %d bits'%(found['bits'],) if 'bits' in found else ''))
+    if 'rule' in found:
+        print('byte rule: %s, %d addresses, %d commands'%(
+            found['rule'] or 'none', found['addresses'], found['commands']))
+    similar = [proto.name for proto in PROTOCOLS.values()
+               if hasattr(proto, 'pre_mark_us') and
+               near(proto.pre_mark_us, found['pre_mark_us']) and
+               near(proto.pre_space_us, found['pre_space_us'])]
+    if similar:
+        print('preamble like: %s'%(','.join(similar),))
+
+
+def main(opts):
+    """ opts is a dict of command line options
+    """
+    widths, lengths, offsets = load(opts['<R>'], int(opts['--jobs']), float(opts['--chunk']))
+    found = analyze(widths, lengths, offsets, int(opts['--bins']))
+    report(found, opts['--verbose'])
+    if not found['frames']:
+        return
+    text = template(found, opts['--name'])
+    print()
+    print(text, end='')
+    if opts['--out']:
+        with open(opts['--out'], 'w') as f_out:
+            f_out.write(text)
+
+
+if __name__ == '__main__':
+    import docopt
+    main(docopt.docopt(usage_text, version='0.0.3'))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""ir_multi.py
+   Several IR receiver ICs on different GPIOs feeding one stream of commands.
+
+   One sensor can't see the whole room. Put a few around it and each gets its own
+   IrReceiver, decoding on its own. They all hand their codes to a MultiReceiver, which
+   passes the first good decode of a transmission on and drops the copies the other
+   sensors decode within --window ms. All the receivers share the pigpio daemon's clock
+   (the tick of the last edge) so 'the same transmission' is easy to tell. The copies
+   can arrive in either order, --bulk receivers post from their own threads and the
+   watchdogs that end the codes fire in gpio order, so it's the distance either way.
+
+   Keep --window well under 50 ms: an NEC repeat's last edge comes about 52 ms after
+   the code it repeats.
+
+   Only codes that passed their protocol's checks get this far, so the first one in is
+   as good as any. A copy that decoded to something else is counted as a conflict and
+   dropped. A sensor that failed to decode it just counts the failure by status, like
+   any IrReceiver.
+
+   MultiReceiver has the consumer side of IrReceiver: get_commands(), wait_commands(),
+   look_for_a_code and notify, so remote_control and pi_daemon can use either.
+"""
+
+import queue
+import threading
+
+import pigpio
+
+from ir_rx import IrReceiver
+import pipe_stats
+
+usage_text = """
+ Usage:
+  ir_multi  [--pins <I>] [--protocols <P>] [--stream] [--window <W>] [--verbose]
+  ir_multi -h | --help
+
+ Options:
+  -h --help               Show this screen.
+  -i --pins <I>           Comma list of Broadcom gpio numbers [default: 3,17]
+  -p --protocols <P>      Comma list from nec,nec-ext,samsung,tivo,rc5,rc6 [default: nec]
+  -m --stream             Decode each edge as it arrives (not rc5 or rc6)
+  -w --window <W>         Codes this close (ms) are one transmission [default: 20]
+  -v --verbose            Print stuff
+    """
+
+
+def tick_offset(t_1, t_2):
+    """ t_2 - t_1 in us, either way round. The ticks wrap, so take the nearer.
+    """
+    diff = (t_2 - t_1) & 0xFFFFFFFF
+    return diff - (1 << 32) if diff >= 1 << 31 else diff
+
+
+class MultiReceiver():
+    """ One IrReceiver per gpio in --pins, merged. The other options are passed to every
+        IrReceiver.
+            opts = {'--pins': '3,17',
+                    '--window': 20,      # ms
+                    ... and any IrReceiver option except --pin
+                   }
+    """
+
+    def __init__(self, pig, **kwargs):
+        self.pig = pig
+        self.window_us = abs(int(kwargs.get('--window', 20))) * 1000
+        self.verbose = kwargs.get('--verbose', False)
+        self.codes = queue.SimpleQueue()    # the merged codes, like IrReceiver.codes
+        self.notify = None
+        self.last_code = None
+        self.no_repeat = None
+        self.code_overflows = 0
+        self.lock = threading.Lock()        # --bulk receivers post from their own threads
+        self.sent = None        # (tick, decoded) of the last code passed on
+        self.receivers = []
+        self.wins = {}          # pin -> codes it was first with
+        self.dups = {}          # pin -> copies dropped
+        self.conflicts = {}     # pin -> copies that decoded differently
+        for pin in str(kwargs.get('--pins', '3')).split(','):
+            opts = dict(kwargs, **{'--pin': int(pin)})
+            rcvr = IrReceiver(pig, **opts)
+            rcvr.notify = (lambda rcvr: lambda: self.merge(rcvr))(rcvr)
+            self.receivers.append(rcvr)
+            self.wins[rcvr.pin_ir] = self.dups[rcvr.pin_ir] = self.conflicts[rcvr.pin_ir] = 0
+        self.look_for_a_code = False
+        pipe_stats.add_collector(self.collect_stats)
+
+
+    @property
+    def look_for_a_code(self):
+        return self.receivers[0].look_for_a_code
+
+
+    @look_for_a_code.setter
+    def look_for_a_code(self, look):
+        for rcvr in self.receivers:
+            rcvr.look_for_a_code = look
+
+
+    @property
+    def counts(self):
+        """ Transmissions by status, summed over the sensors.
+        """
+        counts = dict.fromkeys(self.receivers[0].counts, 0)
+        for rcvr in self.receivers:
+            for status, n_seen in rcvr.counts.items():
+                counts[status] += n_seen
+        return counts
+
+
+    def merge(self, rcvr):
+        """ rcvr posted a code (on its callback thread). Pass it on unless another sensor
+            already passed this transmission on.
+        """
+        pin = rcvr.pin_ir
+        tick = rcvr.last_tick
+        with self.lock:
+            while True:
+                try:
+                    decoded = rcvr.codes.get_nowait()
+                except queue.Empty:
+                    return
+                if self.sent and abs(tick_offset(self.sent[0], tick)) < self.window_us:
+                    if decoded == self.sent[1]:
+                        self.dups[pin] += 1
+                    else:
+                        self.conflicts[pin] += 1
+                        if self.verbose:
+                            print('GPIO%d saw'%(pin,), decoded, 'not', self.sent[1])
+                    continue
+                self.sent = (tick, decoded)
+                self.wins[pin] += 1
+                if self.codes.qsize() < IrReceiver.CODE_CAPACITY:
+                    self.codes.put(decoded)
+                    if self.notify:
+                        self.notify()
+                else:
+                    self.code_overflows += 1
+
+
+    # the consumer side is IrReceiver's
+    next_command = IrReceiver.next_command
+    get_commands = IrReceiver.get_commands
+    wait_commands = IrReceiver.wait_commands
+
+
+    def cancel(self):
+        for rcvr in self.receivers:
+            rcvr.cb_func.cancel()
+
+
+    def collect_stats(self):
+        """ Per sensor merge counters for pipe_stats. Each IrReceiver has its own too.
+        """
+        return [('ir_multi_first_total', 'counter', 'Codes this sensor decoded first',
+                 [('pin="%d"'%(pin,), n) for pin, n in self.wins.items()]),
+                ('ir_multi_duplicate_total', 'counter', 'Copies of a code already passed on',
+                 [('pin="%d"'%(pin,), n) for pin, n in self.dups.items()]),
+                ('ir_multi_conflict_total', 'counter', 'Codes that disagreed with another sensor',
+                 [('pin="%d"'%(pin,), n) for pin, n in self.conflicts.items()])]
+
+
+def test(opts):
+    """ Print merged commands until 10 seconds go by without one, then what each
+        sensor did.
+        opts is a dict of command line options
+    """
+    pig = pigpio.pi()  # open the pi gpio
+    multi = MultiReceiver(pig, **opts)
+    for a_cmd in multi.wait_commands(timeout=10):
+        print(a_cmd)                # tuple of (address, data, protocol)
+    multi.cancel()
+    for rcvr in multi.receivers:
+        pin = rcvr.pin_ir
+        print('GPIO%-2d first %d, duplicate %d, conflict %d,'%(
+            pin, multi.wins[pin], multi.dups[pin], multi.conflicts[pin]), rcvr.counts)
+    pig.stop() # Disconnect from Pi.
+
+
+if __name__ == '__main__':
+    import docopt
+    opts = docopt.docopt(usage_text, version='0.0.3')
+    test(opts)
@@ -0,0 +1,369 @@
+# ir_protocols.py
+# the IR remote protocols IrReceiver can decode
+"""Notes:
+    Each protocol declares its timing in us and IrReceiver compiles them once with its
+    --tolerance into integer windows. make_dispatch() then builds a table keyed on the
+    first two edge widths (the preamble burst and space) so picking the protocol for a
+    transmission is one dict lookup no matter how many protocols are registered.
+
+    The mark-space terminology is flipped like in ir_rx.py: a 'space' is the burst before
+    each NEC data bit and the 'mark' after it holds the bit.
+
+    Add a protocol by writing a class with name, preambles(), decode(a_code)
+    (and check(value) if it streams) and passing it to register().
+
+    The NEC family can also encode(): the nominal edge widths for an address and
+    command, for pig_sim and anything else that needs a remote without a remote.
+    nominal() is just their count and sum, cheap enough for the callback thread.
+"""
+
+import math
+
+# decode() status values. The failures are the messages show_code() prints.
+REPEAT = 'repeat'
+CODE = 'code'
+PRE_FAIL = 'preamble fail'
+SPACE_FAIL = 'bad spaces'
+BYTE_FAIL = 'byte check failed'
+SHORT = 'short code'        # too few edges, or --stream ran out of edges mid code
+STATUSES = (CODE, REPEAT, PRE_FAIL, SPACE_FAIL, BYTE_FAIL, SHORT)
+
+BUCKET_US = 250             # dispatch table resolution
+
+NEVER = (1, 0)              # a window nothing fits in
+
+
+def window(us, tolerance_pct):
+    """ Return the (lo, hi) window in integer us that's within tolerance_pct of us.
+    """
+    lo = us * (1.0 - tolerance_pct*0.01)
+    hi = us * (1.0 + tolerance_pct*0.01)
+    return math.ceil(round(lo, 6)), math.floor(round(hi, 6))
+
+
+class Nec():
+    """ The NEC code my Yamaha sends.
+        A 9 ms burst, 4.5 ms space, then 32 bits lsb first: address, ~address,
+        command, ~command. Each bit is a 560 us burst then a short (0) or long (1) space.
+        Holding a key sends a repeat: 9 ms burst, 2.25 ms space, 560 us burst.
+        The nominal values are what ir_rx has always used at a 40 kHz carrier.
+    """
+    name = 'nec'
+    streams = True              # step() can decode it edge by edge
+    pre_mark_us = 9000
+    pre_space_us = 4500
+    rpt_space_us = 2250         # None if the protocol doesn't have a repeat code
+    rpt_burst_us = 562.5
+    space_us = 600
+    zero_us = 525
+    one_us = 1650
+
+    def __init__(self, tolerance_pct):
+        self.win_pre_mark = window(self.pre_mark_us, tolerance_pct)
+        self.win_pre_space = window(self.pre_space_us, tolerance_pct)
+        if self.rpt_space_us:
+            self.win_rpt_space = window(self.rpt_space_us, tolerance_pct)
+            self.win_rpt_burst = window(self.rpt_burst_us, tolerance_pct)
+        else:
+            self.win_rpt_space = self.win_rpt_burst = NEVER
+        self.win_space = window(self.space_us, tolerance_pct)
+        self.win_zero = window(self.zero_us, tolerance_pct)
+        self.win_one = window(self.one_us, tolerance_pct)
+
+
+    def preambles(self):
+        """ The (burst window, space window) pairs a transmission can start with.
+        """
+        if not self.rpt_space_us:
+            return [(self.win_pre_mark, self.win_pre_space)]
+        return [(self.win_pre_mark, self.win_pre_space),
+                (self.win_pre_mark, self.win_rpt_space)]
+
+
+    def check(self, value):
+        """ Apply the byte rules to the 32 data bits.
+            Return (address, command) or None if they fail.
+        """
+        # odd bytes are the bitwise compliment of evens
+        if (value ^ (value >> 8)) & 0x00FF00FF != 0x00FF00FF:
+            return None
+        return value & 0xFF, (value >> 16) & 0xFF
+
+
+    def bits(self, address, command):
+        """ The 32 data bits that check() turns into (address, command).
+        """
+        return address | (address ^ 0xFF) << 8 | command << 16 | (command ^ 0xFF) << 24
+
+
+    def encode(self, address, command):
+        """ The edge widths in us of a transmission that decode() reads as
+            (address, command). Starts with the preamble burst, ends with the stop burst.
+        """
+        value = self.bits(address, command)
+        a_code = [self.pre_mark_us, self.pre_space_us]
+        for i in range(32):
+            a_code += [self.space_us, self.one_us if (value >> i) & 1 else self.zero_us]
+        a_code.append(self.space_us)
+        return a_code
+
+
+    def nominal(self, address, command):
+        """ (edges, us) of what encode() makes, without making it.
+        """
+        ones = bin(self.bits(address, command)).count('1')
+        return 67, (self.pre_mark_us + self.pre_space_us + 33 * self.space_us +
+                    ones * self.one_us + (32 - ones) * self.zero_us)
+
+
+    def encode_repeat(self):
+        """ The edge widths of a repeat code, None if the protocol doesn't have one.
+        """
+        if not self.rpt_space_us:
+            return None
+        return [self.pre_mark_us, self.rpt_space_us, round(self.rpt_burst_us)]
+
+
+    def decode(self, a_code):
+        """ Decode a transmission from its edge widths in us.
+            Returns (status, address, command).
+        """
+        n_edges = len(a_code)
+        if n_edges < 2:
+            return PRE_FAIL, 0, 0
+        lo, hi = self.win_pre_mark
+        if not lo <= a_code[0] <= hi:
+            return PRE_FAIL, 0, 0
+        pre_space = a_code[1]
+        lo, hi = self.win_rpt_space
+        if lo <= pre_space <= hi and n_edges > 2:
+            lo, hi = self.win_rpt_burst
+            if lo <= a_code[2] <= hi:
+                return REPEAT, 0, 0
+        lo, hi = self.win_pre_space
+        if not lo <= pre_space <= hi:
+            return PRE_FAIL, 0, 0
+
+        lo, hi = self.win_space
+        for space in a_code[2:66:2]:
+            if space < lo or space > hi:
+                return SPACE_FAIL, 0, 0
+        if n_edges < 66:
+            return BYTE_FAIL, 0, 0      # truncated
+
+        z_lo, z_hi = self.win_zero
+        o_lo, o_hi = self.win_one
+        value = 0
+        bit = 1
+        for mark in a_code[3:66:2]:
+            if o_lo <= mark <= o_hi:
+                value |= bit
+            elif mark < z_lo or mark > z_hi:
+                return BYTE_FAIL, 0, 0
+            bit <<= 1
+        checked = self.check(value)
+        if not checked:
+            return BYTE_FAIL, 0, 0
+        return CODE, checked[0], checked[1]
+
+
+class NecExt(Nec):
+    """ Extended NEC: the second byte is more address instead of ~address, so the
+        address is 16 bits. Only the command is checked.
+    """
+    name = 'nec-ext'
+
+    def check(self, value):
+        if (value ^ (value >> 8)) & 0x00FF0000 != 0x00FF0000:
+            return None
+        return value & 0xFFFF, (value >> 16) & 0xFF
+
+
+    def bits(self, address, command):
+        return address | command << 16 | (command ^ 0xFF) << 24
+
+
+class Samsung(Nec):
+    """ My Samsung remote: NEC bits after a 4.5 ms on, 4.5 ms off preamble.
+        The address byte is sent twice instead of inverted. No repeat code,
+        it resends the whole thing.
+    """
+    name = 'samsung'
+    pre_mark_us = 4500
+    rpt_space_us = None
+
+    def check(self, value):
+        if (value ^ (value >> 8)) & 0xFF != 0 or \
+           (value ^ (value >> 8)) & 0x00FF0000 != 0x00FF0000:
+            return None
+        return value & 0xFF, (value >> 16) & 0xFF
+
+
+    def bits(self, address, command):
+        return address | address << 8 | command << 16 | (command ^ 0xFF) << 24
+
+
+class Tivo(Samsung):
+    """ My Tivo: the same equal on-off preamble as the Samsung but the two address
+        bytes differ, so treat it as a 16 bit address. Register it after Samsung.
+    """
+    name = 'tivo'
+
+    def check(self, value):
+        if (value ^ (value >> 8)) & 0x00FF0000 != 0x00FF0000:
+            return None
+        return value & 0xFFFF, (value >> 16) & 0xFF
+
+
+    bits = NecExt.bits
+
+
+class Rc5():
+    """ Philips RC-5: 14 bi-phase bits of 2 x 889 us halves, msb first.
+            start (1), field (inverted command bit 6), toggle, 5 address, 6 command
+        A 1 is space then burst so the first half of the start bit is lost in the idle.
+    """
+    name = 'rc5'
+    streams = False
+    half_us = 889
+    n_bits = 14
+
+    def __init__(self, tolerance_pct):
+        self.win_1t = window(self.half_us, tolerance_pct)
+        self.win_2t = window(2 * self.half_us, tolerance_pct)
+
+
+    def preambles(self):
+        return [(first, second) for first in (self.win_1t, self.win_2t)
+                for second in (self.win_1t, self.win_2t)]
+
+
+    def halves(self, widths, level, n_halves):
+        """ Expand bi-phase edge widths into a list of half-bit levels.
+            Returns None if a width isn't 1 or 2 halves.
+        """
+        lo_1, hi_1 = self.win_1t
+        lo_2, hi_2 = self.win_2t
+        units = []
+        for width in widths:
+            if lo_1 <= width <= hi_1:
+                units.append(level)
+            elif lo_2 <= width <= hi_2:
+                units += [level, level]
+            else:
+                return None
+            level ^= 1
+        return units + [0] * (n_halves - len(units))   # the last space is lost in the idle
+
+
+    def decode(self, a_code):
+        units = self.halves(a_code, 1, 2 * self.n_bits - 1)
+        if units is None:
+            return SPACE_FAIL, 0, 0
+        units = [0] + units     # first half of the start bit
+        if len(units) != 2 * self.n_bits:
+            return BYTE_FAIL, 0, 0
+        value = 0
+        for i in range(0, 2 * self.n_bits, 2):
+            if units[i] == units[i+1]:
+                return BYTE_FAIL, 0, 0
+            value = (value << 1) | units[i+1]
+        # value is S F T A4..A0 C5..C0
+        address = (value >> 6) & 0x1F
+        command = (value & 0x3F) | (0 if value & 0x1000 else 0x40)
+        return CODE, address, command
+
+
+class Rc6(Rc5):
+    """ Philips RC-6 mode 0: a 2.67 ms leader burst and 889 us space, then bi-phase bits of
+        2 x 444 us halves, msb first: start (1), 3 mode bits, a double length toggle bit,
+        8 address, 8 command. A 1 is burst then space, the reverse of RC-5.
+    """
+    name = 'rc6'
+    half_us = 444
+    leader_us = (2666, 889)
+    n_halves = 44           # start 2 + mode 6 + toggle 4 + data 32
+
+    def __init__(self, tolerance_pct):
+        Rc5.__init__(self, tolerance_pct)
+        self.win_3t = window(3 * self.half_us, tolerance_pct)
+        self.win_leader = (window(self.leader_us[0], tolerance_pct),
+                           window(self.leader_us[1], tolerance_pct))
+
+
+    def preambles(self):
+        return [self.win_leader]
+
+
+    def halves(self, widths, level, n_halves):
+        lo_3, hi_3 = self.win_3t
+        units = []
+        for width in widths:
+            if lo_3 <= width <= hi_3:      # toggle half plus a neighbour
+                units += [level, level, level]
+            else:
+                some = Rc5.halves(self, [width], level, 0)
+                if some is None:
+                    return None
+                units += some
+            level ^= 1
+        return units + [0] * (n_halves - len(units))
+
+
+    def decode(self, a_code):
+        (lo_m, hi_m), (lo_s, hi_s) = self.win_leader
+        if len(a_code) < 2 or not lo_m <= a_code[0] <= hi_m or not lo_s <= a_code[1] <= hi_s:
+            return PRE_FAIL, 0, 0
+        units = self.halves(a_code[2:], 1, self.n_halves)
+        if units is None:
+            return SPACE_FAIL, 0, 0
+        if len(units) != self.n_halves or units[0:2] != [1, 0] or \
+           units[8:12] not in ([1, 1, 0, 0], [0, 0, 1, 1]):
+            return BYTE_FAIL, 0, 0
+        bits = units[2:8] + units[12:]
+        value = 0
+        for i in range(0, len(bits), 2):
+            if bits[i] == bits[i+1]:
+                return BYTE_FAIL, 0, 0
+            value = (value << 1) | bits[i]
+        if value >> 16:         # only mode 0
+            return BYTE_FAIL, 0, 0
+        return CODE, value >> 8, value & 0xFF
+
+
+# every protocol we know, by name. Order matters when preambles overlap.
+PROTOCOLS = {}
+
+
+def register(proto_class):
+    """ Add a protocol class to PROTOCOLS so --protocols can name it.
+    """
+    PROTOCOLS[proto_class.name] = proto_class
+    return proto_class
+
+
+for _proto in (Nec, NecExt, Samsung, Tivo, Rc5, Rc6):
+    register(_proto)
+
+
+def make_dispatch(protocols):
+    """ Build the lookup table from the first two edge widths to the protocols that
+        could have sent them. Keys are dispatch_key() of the widths, values are
+        tuples of protocol instances in the order given. Each decode() still checks
+        its own windows, so a bucket that only partly overlaps a window is fine.
+    """
+    dispatch = {}
+    for proto in protocols:
+        for (lo_m, hi_m), (lo_s, hi_s) in proto.preambles():
+            for q_mark in range(lo_m // BUCKET_US, hi_m // BUCKET_US + 1):
+                for q_space in range(lo_s // BUCKET_US, hi_s // BUCKET_US + 1):
+                    key = (q_mark << 16) | q_space
+                    if proto not in dispatch.get(key, ()):
+                        dispatch[key] = dispatch.get(key, ()) + (proto,)
+    return dispatch
+
+
+def dispatch_key(mark, space):
+    """ The make_dispatch() key for a preamble burst and space in us.
+    """
+    return ((mark // BUCKET_US) << 16) | (space // BUCKET_US)
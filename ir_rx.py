@@ -17,47 +17,96 @@
     with my Tivo and Samsung remotes, I see that they don't seem to follow this rule.
     Furthermore, the Tivo doesn't uses an equal time on-off preamble instead of the 1x 2x
     that I expected. Curious.
+    Those (and RC-5/RC-6) live in ir_protocols.py now. Turn them on with --protocols.
 """
 
+from array import array
+import itertools
+import queue
 import time
 
-import docopt
 import pigpio
 
+from log_sink import open_log
+import pipe_stats
+from ir_protocols import (PROTOCOLS, STATUSES, CODE, REPEAT, PRE_FAIL, SHORT, SPACE_FAIL,
+                          BYTE_FAIL, make_dispatch, dispatch_key)
+
 usage_text = """
  Usage:
-  ir_rx  [--glitch <G>] [--pin <I>] [--pre <E>] [--file <F>] [--post <O>] [--raw <R>] [--short <S>] [--tolerance <T>] [--verbose]
+  ir_rx  [--adaptive] [--bulk] [--glitch <G>] [--pin <I>] [--pre <E>] [--file <F>] [--post <O>] [--profile <L>] [--protocols <P>] [--raw <R>] [--short <S>] [--slow <U>] [--stream] [--tolerance <T>] [--verbose]
   ir_rx -h | --help
 
  Options:
   -h --help               Show this screen.
+  -a --adaptive           Retry rejected frames at the remote's own timing, see ir_clock.py
+  -b --bulk               Read edges in batches from a notification pipe, not a callback
   -f --file <F>           File to append codes
   -g --glitch <G>         Glitch in us [default: 100]
   -i --pin <I>            The Broadcom gpio number to use (not J8 pin) [default: 3]
   -o --post <O>           Postamble in ms [default: 15]
   -e --pre <E>            Preamble in ms [default: 50]
-  -r --raw <R>            File to append raw cycles
+  -l --profile <L>        Profile the callback, write it to L on SIGUSR1 and at the end
+  -p --protocols <P>      Comma list from nec,nec-ext,samsung,tivo,rc5,rc6 [default: nec]
+  -r --raw <R>            File to append raw edge widths in us (not with --stream)
   -s --short <S>          Short code length [default: 2]
+  -w --slow <U>           With --profile, sample the stack of calls over U us [default: 1000]
+  -m --stream             Decode each edge as it arrives (not rc5 or rc6)
   -t --tolerance <T>      Tolerance [default: 15]
   -v --verbose            Print stuff
     """
 
+RAW_ROTATE_BYTES = 8000000     # --raw captures roll over to .1, .2 ...
+
+
+def read_raw(file_name):
+    """ Generator over a --raw capture file. Each line is
+            n_edges,w0,w1,...       edge widths in us, starting with the preamble burst
+        Blank lines and lines starting with '#' are skipped.
+    """
+    with open(file_name) as f_in:
+        for line in f_in:
+            line = line.strip()
+            if not line or line[0] == '#':
+                continue
+            fields = line.split(',')
+            yield [int(w) for w in fields[1:int(fields[0])+1]]
+
 
 class IrReceiver():
     """ A class to encapsulate the reception and decoding process.
         Init with a dict of all the options when using it stand-alone.
-            opts = {'--glitch': 100,
+            opts = {'--adaptive': False, # see ir_clock.py
+                    '--bulk': False,     # see ir_bulk.py
+                    '--glitch': 100,
                     '--pin': 3,
                     '--pre': 50,
                     '--file': '',
                     '--post': 15,
+                    '--profile': '',     # see cb_profile.py
+                    '--protocols': 'nec', # see ir_protocols.PROTOCOLS
                     '--raw': '',
                     '--short': 2,        # ignore codes w/ < 2 events
+                    '--slow': 1000,      # --profile: stack samples of calls over 1000 us
+                    '--stream': False,   # decode in the callback, don't buffer events
                     '--tolerance': 15,   # percent deviation from expected periods
                     '--verbose': False,
                    }
     """
     MUTE_CODE = 28
+    EDGE_CAPACITY = 256     # edges kept per transmission. NEC needs 67, the rest is noise
+    CODE_CAPACITY = 32      # decoded transmissions waiting for the consumer
+
+    # fixed attributes keep the instance small and catch typos in the callback
+    __slots__ = ('kwargs', 'pin_ir', 'pre_us', 'post_ms', 'tolerance_pct', 'glitch_us',
+                 'short', 'stream', 'verbose', 'raw', 'file', 'raw_log', 'file_log',
+                 'pig', 'carrier_MHz',
+                 'protocol_names', 'protocols', 'dispatch', 'stream_dispatch', 'families',
+                 'last_tick', 'in_code', 'widths', 'levels', 'n_events',
+                 'edge_overflows', 'code_overflows', 'counts', 'edges_seen', 'decode_lag',
+                 'n_edge', 'first', 'proto', 'candidates', 'value', 'bit', 'repeat', 'failed',
+                 'clock',
+                 'codes', 'notify', 'no_repeat', 'look_for_a_code', 'last_code', 'profiler', 'cb_func')
 
     def __init__(self, pig, **kwargs):
         self.kwargs = kwargs
@@ -67,9 +116,13 @@ class IrReceiver():
         self.tolerance_pct = abs(int(kwargs.get('--tolerance', 15)))
         self.glitch_us = abs(int(kwargs.get('--glitch', 100)))
         self.short = int(kwargs.get('--short', 2))
+        self.stream = kwargs.get('--stream', False)
         self.verbose = kwargs.get('--verbose', False)
         self.raw = kwargs.get('--raw', '')
         self.file = kwargs.get('--file', '')
+        self.raw_log = open_log(self.raw, rotate_bytes=RAW_ROTATE_BYTES) if self.raw else None
+        self.file_log = open_log(self.file) if self.file else None
+        self.protocol_names = kwargs.get('--protocols', 'nec').split(',')
 
         self.pig = pig
 
@@ -81,33 +134,238 @@ class IrReceiver():
         self.pig.set_mode(self.pin_ir, pigpio.INPUT)
         self.pig.set_glitch_filter(self.pin_ir, self.glitch_us) # Ignore glitches.
         self.pig.set_pull_up_down(self.pin_ir, pigpio.PUD_UP)
-        # install the callback
-        cb_func = self.pig.callback(self.pin_ir, pigpio.EITHER_EDGE, self.cbf)
-        assert cb_func        # the daemon might not be running
-
         self.carrier_MHz = 0.04         # 40 kHz - sb a CL arg I guess
+        self.clock = None
+        if kwargs.get('--adaptive'):
+            from ir_clock import ClockRecovery
+            self.clock = ClockRecovery()
+        self.compile_timing()
+
         self.last_tick = 0
         self.in_code = False
-        self.events = []        # the tranmission we're currently building.
-        self.codes = []         # all the transmissions we're storing
-        self.look_for_a_code = False   # tell the instance to watch the IR. Cleared when one found
+        # the tranmission we're currently building. Allocated once so noise can't grow it
+        self.widths = array('I', bytes(4 * IrReceiver.EDGE_CAPACITY))    # us
+        self.levels = array('B', bytes(IrReceiver.EDGE_CAPACITY))        # 1 is a burst
+        self.n_events = 0
+        self.edge_overflows = 0     # edges dropped bc the transmission was too long
+        self.code_overflows = 0     # codes dropped bc the consumer fell behind
+        self.counts = dict.fromkeys(STATUSES, 0)    # transmissions seen, by status
+        self.edges_seen = 0     # every edge the callback got, for the callback rate
+        self.decode_lag = 0     # us from the last edge of a transmission to its decode
+        self.n_edge = 0         # --stream: edges seen in this transmission
+        self.first = 0          # --stream: the preamble burst, until the space picks a protocol
+        self.proto = None       # --stream: the protocol whose windows we're decoding with
+        self.candidates = ()    # --stream: protocols sharing its preamble, checked in order
+        self.value = 0          # --stream: data bits so far, lsb first
+        self.bit = 1            # --stream: where the next data bit goes
+        self.repeat = False     # --stream: the preamble space says it's a repeat
+        self.failed = None      # --stream --adaptive: why step() gave up, retried at the end
+        self.codes = queue.SimpleQueue()   # decoded transmissions posted by the callback thread
+        self.notify = None      # called (on the callback thread) after each post, see pi_daemon
+        self.look_for_a_code = False   # tell the instance to watch the IR
         self.last_code = None   # store the last code for use with "repeat" transmission(s)
+        self.no_repeat = None   # (protocol, address, command) not to repeat, e.g. SpiVolume's
+        pipe_stats.add_collector(self.collect_stats)
+
+        cbf = self.cbf
+        self.profiler = None
+        if kwargs.get('--profile'):
+            from cb_profile import CallbackProfiler     # only load what's asked for
+            self.profiler = CallbackProfiler(kwargs['--profile'], int(kwargs.get('--slow', 1000)))
+            cbf = self.profiler.wrap(cbf)
+
+        # install the callback last, it can fire right away
+        if kwargs.get('--bulk'):
+            from ir_bulk import BulkEdges
+            if self.profiler:   # there's no cbf() call to profile, the batches come here
+                self.cb_func = BulkEdges(self.pig, self, self.profiler.wrap_edges(self.edges),
+                                         self.profiler.wrap_timeout(self.timeout_event))
+            else:
+                self.cb_func = BulkEdges(self.pig, self)    # has cancel() like a callback
+            thread = self.cb_func.thread
+        else:
+            self.cb_func = self.pig.callback(self.pin_ir, pigpio.EITHER_EDGE, cbf)
+            thread = getattr(self.pig, '_notify', None)     # pigpio's callback thread
+        assert self.cb_func        # the daemon might not be running
+        if self.profiler:
+            self.profiler.watch(thread)
+
+
+    def compile_timing(self):
+        """ Build the --protocols timing windows and the preamble dispatch tables once
+            so decoding only does integer compares and one dict lookup per transmission.
+            Call again if the tolerance or protocols change.
+        """
+        self.protocols = [PROTOCOLS[name](self.tolerance_pct) for name in self.protocol_names]
+        self.dispatch = make_dispatch(self.protocols)
+        streams = [proto for proto in self.protocols if proto.streams]
+        self.stream_dispatch = make_dispatch(streams)
+        if self.clock:
+            self.clock.compile(self.protocols, self.tolerance_pct)
+        # protocols with the same preamble only differ in check(). Try them in order
+        self.families = {}
+        for proto in streams:
+            self.families[proto] = tuple(other for other in streams
+                                         if other.preambles() == proto.preambles())
 
 
     def end_of_code(self):
         """ We think we've captured a code.
+            In --stream mode step() has already delivered anything good, so whatever is
+            left is a truncated transmission.
         """
-        if len(self.events) > self.short:
+        if self.stream:
+            if self.clock:
+                self.retry(self.failed or SHORT)
+                return
+            self.counts[SHORT] += 1
+            if self.verbose:
+                print('Truncated after', self.n_edge, 'edges')
+            return
+        n_events = self.n_events
+        if n_events > self.short:
             # normalise(events)
-            self.look_for_a_code = False
-            self.codes.append([e[1] for e in self.events])
+            a_code = memoryview(self.widths)[:n_events]    # no copy
+            status, address, command, name = self.decode_edges(a_code)
+            if self.clock:
+                if status != CODE and status != REPEAT:
+                    status, address, command, name = self.decode_scaled(a_code, status)
+                if status == CODE:
+                    self.clock.learn(name, address,
+                                     self.clock.measure(name, address, command, a_code))
+            self.counts[status] += 1
+            if status in (CODE, REPEAT):
+                self.post(status, address, command, name)
+            if self.raw:
+                self.capture(a_code)
             if self.verbose:
-                print('\nEvent detected; pin is', self.events[0][0], ':', end='')
-                print(' '.join(['%d'%e[1] for e in self.events]))
+                print('\nEvent detected; pin is', self.levels[0], ':', end='')
+                print(' '.join(['%d'%e for e in a_code]))
+            a_code.release()
         else:
+            self.counts[SHORT] += 1
             if self.verbose:
                 print("Short code <", self.short)
-        self.events = []
+        self.n_events = 0
+
+
+    def retry(self, failed):
+        """ --stream --adaptive: the transmission is over and step() didn't deliver it.
+            Try the widths we kept at the remote's timing.
+        """
+        a_code = memoryview(self.widths)[:self.n_events]
+        status, address, command, name = self.decode_scaled(a_code, failed)
+        self.counts[status] += 1
+        if status == CODE or status == REPEAT:
+            if status == CODE:
+                self.clock.learn(name, address, self.clock.measure(name, address, command, a_code))
+            self.post(status, address, command, name)
+        elif self.verbose:
+            print(status, 'after', self.n_edge, 'edges, at any timing')
+        a_code.release()
+        self.n_events = 0
+
+
+    def capture(self, a_code):
+        """ Append one transmission to the --raw file in the format read_raw() expects.
+            The line is buffered by log_sink so the callback thread doesn't touch the disk.
+        """
+        self.raw_log.write('%d,'%(len(a_code),) + ','.join(['%d'%w for w in a_code]))
+
+
+    def post(self, status, address, command, name):
+        """ Hand a decoded transmission to the consumer. This wakes wait_commands().
+            The queue is bounded: if nobody is reading we count and drop.
+            Only the callback thread posts, so the size check can't race another producer.
+        """
+        pipe_stats.EDGE_TO_DECODE.observe(self.decode_lag)
+        if self.codes.qsize() < IrReceiver.CODE_CAPACITY:
+            self.codes.put((status, address, command, name))
+            pipe_stats.DECODE_TO_WRITE.begin()
+            if self.notify:
+                self.notify()
+        else:
+            self.code_overflows += 1
+
+
+    def finish(self, status, address=0, command=0, name=''):
+        """ --stream: step() has decided the transmission. Stop the watchdog,
+            post a good one to the consumer and ignore edges until the next preamble.
+        """
+        if self.clock and status != CODE and status != REPEAT:
+            self.failed = status    # keep the edges coming, retry() gets another go
+            return
+        self.in_code = False
+        self.pig.set_watchdog(self.pin_ir, 0) # Cancel watchdog.
+        self.decode_lag = 0     # we're still in the last edge's callback
+        self.counts[status] += 1
+        if status == CODE or status == REPEAT:
+            if self.clock and status == CODE:
+                self.clock.learn(name, address, self.clock.measure(
+                    name, address, command, memoryview(self.widths)[:self.n_events]))
+            self.post(status, address, command, name)
+        if self.verbose:
+            print(status, name, address, command, 'after', self.n_edge, 'edges')
+
+
+    def step(self, edge):
+        """ --stream: classify one edge width (us) as it arrives and keep the bits in
+            an int. The preamble picks the protocol from the stream dispatch table, then
+            its windows are used for the rest. A transmission is thrown out at the first
+            edge that doesn't fit, and a code is delivered when the stop burst after the
+            32nd data bit ends, without waiting for the watchdog.
+        """
+        n_edge = self.n_edge
+        self.n_edge = n_edge + 1
+        if n_edge & 1:
+            if n_edge == 1:     # preamble space. Now we know which protocol
+                first = self.first
+                for proto in self.stream_dispatch.get(dispatch_key(first, edge), ()):
+                    lo, hi = proto.win_pre_mark
+                    if lo <= first <= hi:
+                        lo, hi = proto.win_pre_space
+                        if lo <= edge <= hi:
+                            self.proto = proto
+                            self.candidates = self.families[proto]
+                            return
+                        lo, hi = proto.win_rpt_space
+                        if lo <= edge <= hi:        # the short space of a repeat
+                            self.proto = proto
+                            self.repeat = True
+                            return
+                self.finish(PRE_FAIL)
+                return
+            lo, hi = self.proto.win_one         # a data mark
+            if lo <= edge <= hi:
+                self.value |= self.bit
+            else:
+                lo, hi = self.proto.win_zero
+                if edge < lo or edge > hi:
+                    self.finish(BYTE_FAIL)
+                    return
+            self.bit <<= 1
+
+        elif n_edge == 0:       # preamble burst
+            self.first = edge
+
+        elif self.repeat:       # the burst that ends a repeat
+            lo, hi = self.proto.win_rpt_burst
+            if lo <= edge <= hi:
+                self.finish(REPEAT, 0, 0, self.proto.name)
+            else:
+                self.finish(PRE_FAIL)
+
+        else:                   # a space burst. The 33rd is the stop burst
+            lo, hi = self.proto.win_space
+            if edge < lo or edge > hi:
+                self.finish(SPACE_FAIL)
+            elif n_edge == 66:
+                for proto in self.candidates:
+                    checked = proto.check(self.value)
+                    if checked:
+                        self.finish(CODE, checked[0], checked[1], proto.name)
+                        return
+                self.finish(BYTE_FAIL)
 
 
     def cbf(self, gpio, level, tick):
@@ -120,43 +378,95 @@ class IrReceiver():
         if level != pigpio.TIMEOUT:    # here's an edge
             edge = pigpio.tickDiff(self.last_tick, tick)
             self.last_tick = tick
-
+            self.edges_seen += 1
             if self.look_for_a_code:
-                if (edge > self.pre_us) and (not self.in_code): # Start of a code.
-                    self.in_code = True
-                    self.pig.set_watchdog(self.pin_ir, self.post_ms) # Start watchdog.
-
-                elif (edge > self.post_ms * 1000) and self.in_code: # End of a code.
-                    self.in_code = False
-                    self.pig.set_watchdog(self.pin_ir, 0) # Cancel watchdog.
-                    self.end_of_code()
+                self.edge_event(edge, level)
+        else:   # timeout. Perhaps we have a code to store
+            self.timeout_event(tick)
 
-                elif self.in_code:
-                    # flip polarity bc hardware low means burst detected
-                    self.events.append((0 if level else 1, edge),)
 
-        else:   # timeout. Perhaps we have a code to store
+    def edges(self, ticks, levels):
+        """ --bulk: a run of edges read from the notification pipe, see ir_bulk.py.
+            ticks and levels are lists; a level is nonzero if the pin is high after
+            the edge. The widths for the whole run are worked out in one go.
+        """
+        widths = [(tick - last) & 0xFFFFFFFF
+                  for last, tick in zip(itertools.chain((self.last_tick,), ticks), ticks)]
+        self.last_tick = ticks[-1]
+        self.edges_seen += len(ticks)
+        if self.look_for_a_code:
+            edge_event = self.edge_event
+            for edge, level in zip(widths, levels):
+                edge_event(edge, level)
+
+
+    def edge_event(self, edge, level):
+        """ One edge, edge us after the one before.
+        """
+        if (edge > self.pre_us) and (not self.in_code): # Start of a code.
+            self.in_code = True
+            self.n_edge, self.value, self.bit, self.repeat = 0, 0, 1, False
+            self.failed, self.n_events = None, 0
+            self.pig.set_watchdog(self.pin_ir, self.post_ms) # Start watchdog.
+
+        elif (edge > self.post_ms * 1000) and self.in_code: # End of a code.
+            self.in_code = False
             self.pig.set_watchdog(self.pin_ir, 0) # Cancel watchdog.
+            self.decode_lag = edge
+            self.end_of_code()
+
+        elif self.stream:
             if self.in_code:
-                self.in_code = False
-                self.end_of_code()
+                if self.clock and self.n_events < IrReceiver.EDGE_CAPACITY:
+                    self.widths[self.n_events] = edge     # for retry()
+                    self.n_events += 1
+                if not self.failed:
+                    self.step(edge)
+
+        elif self.in_code:
+            n_events = self.n_events
+            if n_events < IrReceiver.EDGE_CAPACITY:
+                self.widths[n_events] = edge
+                # flip polarity bc hardware low means burst detected
+                self.levels[n_events] = 0 if level else 1
+                self.n_events = n_events + 1
+            else:
+                self.edge_overflows += 1
 
 
-    def match(self, observed, expected):
-        """ Handy function to match an observed list with a test list
-            including a tolerance for error in the timing.
-            Returns True if observed matches expected within tolerance.
+    def timeout_event(self, tick):
+        """ The watchdog went off: no edges for --post ms.
         """
-        for pair in zip(observed, expected):
-            if pair[0] < pair[1] * (1.0 - self.tolerance_pct*0.01):
-                return False
-            if pair[0] > pair[1] * (1.0 + self.tolerance_pct*0.01):
-                return False
-        return True
+        self.pig.set_watchdog(self.pin_ir, 0) # Cancel watchdog.
+        if self.in_code:
+            self.in_code = False
+            self.decode_lag = pigpio.tickDiff(self.last_tick, tick)
+            self.end_of_code()
+
+
+    def collect_stats(self):
+        """ The receiver's counters for pipe_stats. Read when somebody asks, so the
+            callback only pays for the increments.
+        """
+        pin = 'pin="%d"'%(self.pin_ir,)
+        return [('ir_transmissions_total', 'counter', 'IR transmissions by decode status',
+                 [('%s,status="%s"'%(pin, status), n) for status, n in self.counts.items()]),
+                ('ir_edges_total', 'counter', 'Edges seen by the IR callback',
+                 [(pin, self.edges_seen)]),
+                ('ir_edge_overflows_total', 'counter', 'Edges dropped, transmission too long',
+                 [(pin, self.edge_overflows)]),
+                ('ir_code_overflows_total', 'counter', 'Codes dropped, consumer too slow',
+                 [(pin, self.code_overflows)]),
+                ('ir_queue_depth', 'gauge', 'Decoded codes waiting for the consumer',
+                 [(pin, self.codes.qsize())])] + \
+               (self.clock.collect_stats(pin) if self.clock else [])
 
 
     def close(self):
         # cleanup
+        if self.profiler:
+            self.profiler.close()
+            self.profiler.dump()
         self.pig.stop() # Disconnect from Pi.
 
 
@@ -166,57 +476,42 @@ class IrReceiver():
         return [self.carrier_MHz * event for event in a_code]
 
 
-    def is_repeat(self, cycles):
-        # detect the nec 'repeat' transmission
-        return self.match(cycles, [360, 90, 22.5])
-
-
-    def has_preample(self, cycles):
-        # detect the nec preamble
-        return self.match(cycles, [360, 180,]) # or self.match(cycles, [180, 180,])
-
-
-
     def str_cycles(self, cycles):
         # format length: x0 x1 x2 ...
         m_str = '%d: '%(len(cycles),) + ' '.join(['%2.0f'%round(c) for c in cycles])
         return m_str
 
 
-    def one_mark(self, mark):
-        """ The nec marks and spaces are defined by their cycle count.
-            Return a '1', '0', (or 'x' if it matches neither).
-            Used by decode_nec() to make a binary repr of the data
+    def decode_edges(self, a_code):
+        """ Decode a code straight from its edge widths in us. The first two widths pick
+            the candidate protocols from the dispatch table built by compile_timing().
+            Returns (status, address, command, protocol name) where status is REPEAT, CODE,
+            or the first candidate's failure: PRE_FAIL, SPACE_FAIL, BYTE_FAIL.
         """
-        if self.match([mark], [21.0]):
-            return '0'
-        if self.match([mark], [66.0]):
-            return '1'
-        return 'x'  # not a 1 or a 0
-
-
-    def decode_nec(self, marks):
-        """ Preamble and spaces have been stripped before calling decode_nec().
-            Check that all the remaining events are either a 0 or 1
-            Convert to bytes and perform the inversion check
-            Return the address and command bytes along with a bool indicating valid
+        if len(a_code) < 2:
+            return PRE_FAIL, 0, 0, ''
+        failed = PRE_FAIL
+        for i, proto in enumerate(self.dispatch.get(dispatch_key(a_code[0], a_code[1]), ())):
+            status, address, command = proto.decode(a_code)
+            if status == CODE or status == REPEAT:
+                return status, address, command, proto.name
+            if not i:
+                failed = status
+        return failed, 0, 0, ''
+
+
+    def decode_scaled(self, a_code, failed):
+        """ --adaptive: try a transmission that was rejected at nominal timing again at
+            the timing scales ir_clock suggests. Returns the first that decodes, else failed.
         """
-        b_str = ''.join([self.one_mark(c) for c in marks])[::-1]  # binary, reversed
-        if self.verbose:
-            print('b_str', b_str)
-        if 'x' in b_str:
-            address, command, b_ok = 0, 0, False    # any 'x' was outside of tolerance
-        else:
-            # separate into 8 bit blocks and convert to int and reverse again
-            i_values = [int(b_str[i:i+8], 2) for i in range(0, 32, 8)][::-1]
-            # odd values are the bitwise compliment of evens. Should sum to 255
-            add_ok = i_values[0] + i_values[1] == 255
-            cmd_ok = i_values[2] + i_values[3] == 255
-            if self.verbose:
-                print('values', i_values)
-                print(add_ok, cmd_ok, ['{0:08b}'.format(x) for x in i_values])
-            address, command, b_ok = i_values[0], i_values[2], add_ok and cmd_ok
-        return address, command, b_ok
+        if len(a_code) < 2:
+            return failed, 0, 0, ''
+        for scale in self.clock.scales(self.protocols, a_code[0], a_code[1]):
+            decoded = self.decode_edges([round(width / scale) for width in a_code])
+            if decoded[0] == CODE or decoded[0] == REPEAT:
+                self.clock.rescued += 1
+                return decoded
+        return failed, 0, 0, ''
 
 
     def show_code(self, a_code):
@@ -232,56 +527,68 @@ class IrReceiver():
         cycles = self.to_cycles(a_code)
         if self.verbose:
             print('\nall cycles', self.str_cycles(cycles))
-        if self.raw:
-            with open(self.raw_file, 'a') as f_out:
-                c_str = '%d,'%(len(cycles),) + ','.join(['%2.0f'%round(c) for c in cycles])
-                f_out.write(c_str+'\n')
-
-        if self.is_repeat(cycles):
-            print('repeat')
-        elif self.has_preample(cycles):
-            # it has a preamble. Check that the spaces are OK
-            if self.match(cycles[2::2], [24.0]*32):
-                address, command, b_ok = self.decode_nec(cycles[3::2])
-                if b_ok:
-                    print('code', address, command, b_ok)
-                    if self.opts['--file']:
-                        with open(self.opts['--file'], 'a') as f_out:
-                            f_out.write(','.join([str(x) for x in (address, command)])+'\n')
-                else:
-                    print('byte check failed')
-            else:
-                print('bad spaces')
+
+        status, address, command, name = self.decode_edges(a_code)
+        if status == CODE:
+            print('code', name, address, command, True)
+            if self.file_log:
+                self.file_log.write(','.join([str(x) for x in (address, command)]))
         else:
-            print('preamble fail')
+            print(status)
+
+
+    def next_command(self, decoded):
+        """ Turn one decoded (status, address, command, protocol) from the codes queue
+            into a command.
+            Returns (address, command, protocol), or None if there's nothing to act on.
+            A 'repeat' code returns a copy of the previous code,
+                Unless the previous code is in no_repeat (the keymap's norepeat keys),
+                or without a no_repeat, was a 'mute' command.
+        """
+        status, address, command, name = decoded
+        if status == REPEAT:
+            last_code = self.last_code
+            if not last_code:
+                return None
+            if self.no_repeat is None:
+                if last_code[1] == IrReceiver.MUTE_CODE:
+                    return None         # don't repeat a mute command
+            elif (last_code[2], last_code[0], last_code[1]) in self.no_repeat:
+                return None
+            return last_code
+        self.last_code = (address, command, name)
+        return self.last_code
 
 
     def get_commands(self):
-        """ generator to return each valid decoded code,
-            'repeat' code returns a copy of the previous code,
-                Unless the previous code was a 'mute' command.
-            The function consumes the codes list.
+        """ generator to return each valid decoded code that has arrived so far.
+            Doesn't block. The function consumes the codes queue.
+        """
+        while True:
+            try:
+                decoded = self.codes.get_nowait()
+            except queue.Empty:
+                break
+            a_cmd = self.next_command(decoded)
+            if a_cmd:
+                yield a_cmd
+
+
+    def wait_commands(self, timeout=None):
+        """ Blocking generator for an event driven consumer.
+            Sleeps on the codes queue and yields each command as soon as the callback
+            posts it, so there's no polling. Stops after timeout seconds
+            without a transmission (None waits forever).
         """
-        codes_cpy = self.codes[::-1]
-        self.codes = []
-        while codes_cpy:
+        self.look_for_a_code = True
+        while True:
             try:
-                a_code = codes_cpy.pop()  # code list is reversed - get the oldest
-            except IndexError:
-                break   # should raise StopIteration() if our copy is empty
-            cycles = self.to_cycles(a_code)
-            if self.is_repeat(cycles):
-                if self.last_code and self.last_code[1] == IrReceiver.MUTE_CODE:
-                    continue        # don't repeat a mute command
-                yield(self.last_code)
-
-            elif self.has_preample(cycles):
-                # it has a preamble. Check that the spaces are OK
-                if self.match(cycles[2::2], [24.0]*32):
-                    address, command, b_ok = self.decode_nec(cycles[3::2])
-                    if b_ok:
-                        self.last_code = (address, command,)
-                        yield(address, command,)
+                decoded = self.codes.get(timeout=timeout)
+            except queue.Empty:
+                return
+            a_cmd = self.next_command(decoded)
+            if a_cmd:
+                yield a_cmd
 
 
 def test(opts):
@@ -294,11 +601,10 @@ def test(opts):
     t_start = time.time()
     done = False                        # loop until our 10 seconds elapses
     while not done:
-        # each time we rx a complete code, we stop looking
-        rcvr.look_for_a_code = True     # keep telling the IrReceiver to look
+        rcvr.look_for_a_code = True     # tell the IrReceiver to look
 
         for a_cmd in rcvr.get_commands():
-            print(a_cmd)                # tuple of (address, data)
+            print(a_cmd)                # tuple of (address, data, protocol)
 
         if time.time() > t_start + 10:  # don't run forever
             rcvr.close()
@@ -308,12 +614,12 @@ def test(opts):
     rcvr.pig.stop() # Disconnect from Pi.
 
     # show what we captured - should be empty bc get_commands() drains codes
-    for a_code in rcvr.codes:
-        print('oops, get_commands() let one go', end='')
-        rcvr.show_code(a_code)
+    while not rcvr.codes.empty():
+        print('oops, get_commands() let one go', rcvr.codes.get())
 
 
 if __name__ == '__main__':
+    import docopt
     opts = docopt.docopt(usage_text, version='0.0.3')
     test(opts)
     if opts['--verbose']:
@@ -15,6 +15,8 @@
 # Change the next 3 lines to suit where you install your script and what you want to call it
 DIR=/home/pi/ir_rx
 DAEMON=$DIR/remote_control.py
+# or run the volume control and the water meter together on one pigpio connection
+# DAEMON=$DIR/pi_daemon.py
 DAEMON_NAME=ir_rx
 
 # Add any command line options for your daemon here
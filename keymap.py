@@ -0,0 +1,106 @@
+# keymap.py
+# read the remote control keymap file that SpiVolume --keymap uses
+"""Notes:
+    One key per line, '#' starts a comment:
+
+        # protocol address command  actions           [norepeat]
+        nec        122     26       up
+        nec        122     27       down
+        nec        122     28       mute              norepeat
+        nec        122     1        gain=160
+        samsung    7       7        up=2
+        nec        122     10       gain=120;mute=0   norepeat
+
+    protocol is a name from ir_protocols. Actions:
+        up[=n] down[=n]     n volume steps (1 dB each, default 1). Unmutes instead if muted
+        gain=g              jump to gain g, 0 to 255
+        mute                toggle
+        mute=1 mute=0       mute, unmute
+    Several actions separated by ';' run in order (a macro).
+
+    With SpiVolume --zones (daisy chained PGA2311s) an action can end in @ and the zones
+    it's for, numbered from 1, or a group named on a zone line. Without @ it's for all
+    of them.
+
+        zone    upstairs 2,3
+        nec        122     26       up@1
+        nec        122     10       mute@upstairs     norepeat
+        nec        122     11       gain=140@2,3;mute=0@2,3
+
+    A held key sends NEC repeat codes, which run the key again unless it's 'norepeat'.
+
+    load_keymap() just parses and checks. SpiVolume compiles the entries into its
+    dispatch table.
+"""
+
+from ir_protocols import PROTOCOLS
+
+ACTIONS = ('up', 'down', 'gain', 'mute')
+
+
+def parse_zones(text, groups):
+    """ '1,3' -> (1, 3). A group name is its zones.
+    """
+    zones = ()
+    for item in text.split(','):
+        if item in groups:
+            zones += groups[item]
+        elif item.isdigit() and int(item) > 0:
+            zones += (int(item),)
+        else:
+            raise ValueError('unknown zone %r'%(item,))
+    return tuple(sorted(set(zones)))
+
+
+def parse_action(text, groups=None):
+    """ 'up=2' -> ('up', 2, None), 'mute@1,2' -> ('mute', None, (1, 2))
+        The zones are None for all of them.
+    """
+    text, at, zone_text = text.partition('@')
+    zones = parse_zones(zone_text, groups or {}) if at else None
+    name, _, arg = text.partition('=')
+    if name not in ACTIONS:
+        raise ValueError('unknown action %r'%(name,))
+    if not arg:
+        if name == 'gain':
+            raise ValueError('gain needs a value')
+        return name, (1 if name in ('up', 'down') else None), zones
+    value = int(arg)
+    if name == 'gain' and not 0 <= value <= 255:
+        raise ValueError('gain %d is not 0 to 255'%(value,))
+    if name == 'mute' and value not in (0, 1):
+        raise ValueError('mute is 0 or 1')
+    return name, value, zones
+
+
+def parse_keymap(lines):
+    """ Returns a list of ((protocol, address, command), [(action, arg, zones)...], repeats).
+        Raises ValueError naming the line for anything it doesn't understand.
+    """
+    entries = []
+    groups = {}
+    for line_no, line in enumerate(lines, 1):
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        try:
+            if fields[0] == 'zone':
+                if len(fields) != 3 or fields[1].isdigit():
+                    raise ValueError('expected: zone name zones')
+                groups[fields[1]] = parse_zones(fields[2], groups)
+                continue
+            if len(fields) not in (4, 5) or (len(fields) == 5 and fields[4] != 'norepeat'):
+                raise ValueError('expected: protocol address command actions [norepeat]')
+            if fields[0] not in PROTOCOLS:
+                raise ValueError('unknown protocol %r'%(fields[0],))
+            key = (fields[0], int(fields[1]), int(fields[2]))
+            actions = [parse_action(action, groups) for action in fields[3].split(';')]
+        except ValueError as err:
+            raise ValueError('line %d: %s'%(line_no, err))
+        entries.append((key, actions, len(fields) == 4))
+    return entries
+
+
+def load_keymap(file_name):
+    with open(file_name) as f_in:
+        return parse_keymap(f_in)
@@ -0,0 +1,203 @@
+# log_sink.py
+# buffered log files written by one background thread
+"""Notes:
+    SpiVolume, IrReceiver and CaptureEncoder all used to open their log file for every
+    line, on whatever thread happened to be doing the work. On a busy SD card that open
+    (and the write) can take a long time and it wears the card.
+
+    open_log() returns a LogSink for a file name; asking twice for the same file gets the
+    same sink. write() just adds the line to an in-memory buffer. A single writer thread
+    flushes every sink when one has FLUSH_LINES waiting or FLUSH_SECONDS have passed,
+    and once more at exit.
+
+    'At exit' is atexit, and a signal's default action skips it: SIGTERM would lose up
+    to FLUSH_SECONDS of every log. So every entry point that runs as a daemon has to
+    turn SIGTERM into a normal exit, or call flush_logs() itself before it goes.
+    remote_control.py (what irdaemon.sh runs) makes it a SystemExit, pi_daemon.py
+    catches it in its asyncio loop and shuts down in order.
+
+    The buffer is bounded. If the card stalls long enough to fill it, the oldest lines
+    are dropped and counted in sink.dropped. Binary sinks never drop: a record lost from
+    the middle would shift every record after it. write() waits for the writer instead,
+    and records a failed flush couldn't write go back in the buffer.
+
+    A 'replace' sink only keeps its last line and rewrites the file with it (SpiVolume's
+    current volume file and state). The new file is synced and renamed over the old one
+    so a power cut leaves one or the other, never half. Other sinks append and can rotate at rotate_bytes:
+    file -> file.1 -> file.2 ... keeping `backups` old files.
+
+    A 'binary' sink takes bytes records instead of lines and writes them back to back.
+"""
+
+import atexit
+import collections
+import os
+import threading
+
+FLUSH_SECONDS = 5.0
+FLUSH_LINES = 100
+MAX_LINES = 10000           # per sink, before dropping
+
+
+class LogSink():
+    """ One buffered log file. Use open_log() rather than making these directly.
+    """
+
+    def __init__(self, file_name, replace=False, rotate_bytes=0, backups=3, binary=False):
+        self.file_name = file_name
+        self.replace = replace
+        self.binary = binary
+        self.rotate_bytes = rotate_bytes
+        self.backups = backups
+        # a binary sink is bounded by write() waiting, a failed flush can refill it
+        self.lines = collections.deque(maxlen=1 if replace else None if binary else MAX_LINES)
+        self.lock = threading.Lock()          # the buffer
+        self.space = threading.Condition(self.lock)     # a binary sink waits on a full one
+        self.flush_lock = threading.Lock()    # the file, so flushes don't interleave
+        self.dropped = 0
+
+
+    def write(self, line):
+        """ Queue a line (without the newline), or a bytes record for a binary sink,
+            for the writer thread. Never blocks on disk, except a binary sink that's full.
+        """
+        with self.lock:
+            if self.binary and not self.replace:
+                while len(self.lines) >= MAX_LINES:
+                    _writer.wake()
+                    self.space.wait(FLUSH_SECONDS)
+            elif len(self.lines) == self.lines.maxlen and not self.replace:
+                self.dropped += 1
+            self.lines.append(line)
+            n_lines = len(self.lines)
+        if n_lines >= FLUSH_LINES:
+            _writer.wake()
+
+
+    def flush(self):
+        """ Write out whatever is buffered. Called from the writer thread and at exit.
+        """
+        with self.flush_lock:
+            with self.lock:
+                if not self.lines:
+                    return
+                lines = list(self.lines)
+                self.lines.clear()
+                self.space.notify_all()
+            if self.binary and not self.replace:
+                try:
+                    self.append_records(b''.join(lines))
+                except OSError:
+                    with self.lock:     # put them back in front of anything newer
+                        self.lines.extendleft(reversed(lines))
+                    raise
+                return
+            if self.binary:
+                text = b''.join(lines)
+            else:
+                text = '\n'.join(lines) + '\n'
+            b_flag = 'b' if self.binary else ''
+            if self.replace:
+                tmp_name = self.file_name + '.tmp'
+                with open(tmp_name, 'w' + b_flag) as fout:
+                    fout.write(text)
+                    fout.flush()
+                    os.fsync(fout.fileno())
+                os.replace(tmp_name, self.file_name)
+                return
+            with open(self.file_name, 'a' + b_flag) as fout:
+                fout.write(text)
+                size = fout.tell()
+            if self.rotate_bytes and size > self.rotate_bytes:
+                self.rotate()
+
+
+    def append_records(self, data):
+        """ Append binary records whole or not at all, so a half written one can't shift
+            the ones after it.
+        """
+        with open(self.file_name, 'ab') as fout:
+            start = fout.tell()
+            try:
+                fout.write(data)
+                fout.flush()
+            except OSError:
+                fout.truncate(start)
+                raise
+            size = fout.tell()
+        if self.rotate_bytes and size > self.rotate_bytes:
+            self.rotate()
+
+
+    def rotate(self):
+        """ Shift file.N-1 to file.N ... file to file.1, dropping the oldest.
+        """
+        for i in range(self.backups, 0, -1):
+            older = '%s.%d'%(self.file_name, i - 1) if i > 1 else self.file_name
+            if os.path.exists(older):
+                os.replace(older, '%s.%d'%(self.file_name, i))
+
+
+class LogWriter():
+    """ The one thread that flushes every sink.
+    """
+
+    def __init__(self):
+        self.sinks = {}
+        self.cond = threading.Condition()
+        self.thread = None
+
+
+    def open(self, file_name, **kwargs):
+        with self.cond:
+            sink = self.sinks.get(file_name)
+            if not sink:
+                sink = self.sinks[file_name] = LogSink(file_name, **kwargs)
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, name='log_sink', daemon=True)
+                self.thread.start()
+        return sink
+
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify()
+
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait(FLUSH_SECONDS)
+                sinks = list(self.sinks.values())
+            for sink in sinks:
+                try:
+                    sink.flush()
+                except OSError as err:      # keep going, the card may come back
+                    print('log_sink:', sink.file_name, err)
+
+
+    def flush(self):
+        with self.cond:
+            sinks = list(self.sinks.values())
+        for sink in sinks:
+            sink.flush()
+
+
+_writer = LogWriter()
+
+
+def open_log(file_name, replace=False, rotate_bytes=0, backups=3, binary=False):
+    """ Return the shared LogSink for file_name, starting the writer thread if needed.
+        The options only count the first time a file is opened.
+    """
+    return _writer.open(file_name, replace=replace, rotate_bytes=rotate_bytes, backups=backups,
+                        binary=binary)
+
+
+def flush_logs():
+    """ Write everything buffered now, e.g. before shutting down.
+    """
+    _writer.flush()
+
+
+atexit.register(flush_logs)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""pi_daemon.py
+   The IR volume control and the water meter in one process on one pigpio connection.
+
+   Everything runs on one asyncio loop. pigpio's callback thread still does the time
+   critical part (IrReceiver decodes edges there) and then hands off with
+   call_soon_threadsafe, so the loop sleeps until there's something to do:
+       ir       IrReceiver posts a code -> wake the remote task -> SpiVolume.write_command()
+       water    a meter edge -> CaptureEncoder.meter_cbf() on the loop. The heartbeat
+                LED is a script inside the daemon
+   SpiVolume keeps its --interval writer thread for coalescing and slew.
+
+   Turn parts off with --components, e.g. --components water.
+"""
+
+import asyncio
+from datetime import datetime
+import signal
+
+import pigpio
+
+from capture_encoder import CaptureEncoder
+from log_sink import flush_logs
+import pipe_stats
+from remote_control import init_devs
+
+usage_text = """
+ Usage:
+  pi_daemon  [--components <C>] [--binlog <B>] [--debounce <D>] [--file <F>] [--heartbeat <H>] [--leak <K>] [--led <L>] [--meter <M>] [--rollup <R>] [--stats <S>] [--verbose]
+  pi_daemon -h | --help
+
+ Options:
+  -h --help               Show this screen.
+  -c --components <C>     Comma list from remote,water [default: remote,water]
+  -b --binlog <B>         Binary water log, see water_log.py
+  -d --debounce <D>       Water meter debounce in s [default: 0.09]
+  -f --file <F>           Water log [default: /home/pi/wet/waterlog.txt]
+  -e --heartbeat <H>      Heartbeat LED period in s [default: 1.0]
+  -k --leak <K>           Minutes of nonstop flow that is a leak [default: 120]
+  -l --led <L>            Heartbeat LED GPIO [default: 15]
+  -m --meter <M>          Water meter GPIO [default: 4]
+  -r --rollup <R>         Water totals file, see water_flow.py
+  -s --stats <S>          pipe_stats socket, '' for none [default: /tmp/ir_rx.stats]
+  -v --verbose            Print stuff
+    """
+
+LEAK_CHECK_S = 60
+
+
+async def remote_task(rcvr, spi_vol):
+    """ Pass IR commands to the volume control whenever the receiver posts one.
+    """
+    loop = asyncio.get_running_loop()
+    posted = asyncio.Event()
+    rcvr.notify = lambda: loop.call_soon_threadsafe(posted.set)
+    rcvr.look_for_a_code = True
+    while True:
+        await posted.wait()
+        posted.clear()
+        for a_cmd in rcvr.get_commands():
+            spi_vol.write_command(a_cmd)
+
+
+async def leak_task(encoder):
+    """ Say so once when the water has been running too long, and again when it stops.
+    """
+    leaking = False
+    while True:
+        await asyncio.sleep(LEAK_CHECK_S)
+        now = datetime.now()
+        if encoder.flow.leak(now) != leaking:
+            leaking = not leaking
+            print(now.strftime('%y-%m-%d %H:%M:%S'), 'leak!' if leaking else 'leak over',
+                  '%.2f gpm'%(encoder.flow.flow_gpm(now),))
+
+
+async def main(opts):
+    """ Start the components in opts['--components'] and run until SIGTERM or SIGINT.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    components = opts['--components'].split(',')
+    pig = pigpio.pi()
+    if not pig.connected:
+        raise SystemExit('pi_daemon: is pigpiod running?')
+
+    tasks = []
+    spi_vol = rcvr = encoder = None
+    if 'remote' in components:
+        pig, spi_vol, rcvr = init_devs(pig)
+        tasks.append(asyncio.create_task(remote_task(rcvr, spi_vol)))
+    if 'water' in components:
+        encoder = CaptureEncoder(pig, opts)
+        encoder.start(deliver=loop.call_soon_threadsafe)
+        tasks.append(asyncio.create_task(leak_task(encoder)))
+    if opts['--stats']:
+        pipe_stats.serve(opts['--stats'])
+
+    await stopping.wait()
+
+    for task in tasks:
+        task.cancel()
+    if encoder:
+        encoder.stop()
+        encoder.flow.flush()
+    if rcvr:
+        rcvr.cb_func.cancel()
+    if spi_vol:
+        spi_vol.close()
+    flush_logs()
+    pig.stop()
+
+
+if __name__ == '__main__':
+    import docopt
+    asyncio.run(main(docopt.docopt(usage_text, version='0.0.3')))
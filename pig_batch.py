@@ -0,0 +1,128 @@
+# pig_batch.py
+# send several pigpio commands in one round trip
+"""Notes:
+    Every pigpio.pi() method is a request and a reply over the daemon's socket, and the
+    next one isn't sent until the reply comes back. A PigBatch collects commands and
+    sends them all in one go, then reads all the replies, so one logical action
+    (unmute and set the gain, toggle the LED and read the meter) costs one round trip.
+
+    pigpio stored scripts would do this inside the daemon but they can't do SPI
+    transfers, so we pipeline on the socket instead. We hold the pigpio.pi() socket lock
+    while we do it, the same way pigpio's own spi_xfer() does, so other threads using
+    the same pi() just wait their turn.
+
+    If the pi() doesn't have a socket (ReplayPi and friends) the commands are simply
+    made one at a time through its methods.
+
+        batch = PigBatch(pig)
+        batch.write(25, 1)
+        batch.spi_xfer(handle, bytes([180, 180]))
+        res_write, (count, rx_data) = batch.run()
+"""
+
+import struct
+
+import pigpio
+
+# pigpio socket command numbers (the _PI_CMD_* values in pigpio.py)
+CMD_READ = 3
+CMD_WRITE = 4
+CMD_TICK = 16
+CMD_SPIX = 75
+
+# which pi() method does the same thing, for the one at a time fallback
+METHODS = {CMD_READ: 'read', CMD_WRITE: 'write', CMD_TICK: 'get_current_tick',
+           CMD_SPIX: 'spi_xfer'}
+
+
+class PigBatch():
+    """ Collect pigpio commands and send them in one round trip with run().
+    """
+
+    def __init__(self, pig):
+        self.pig = pig
+        self.cmds = []
+
+
+    def read(self, gpio):
+        """ Queue a pi.read(gpio). Its result is the level.
+        """
+        self.cmds.append((CMD_READ, gpio, 0, b''))
+        return self
+
+
+    def write(self, gpio, level):
+        """ Queue a pi.write(gpio, level).
+        """
+        self.cmds.append((CMD_WRITE, gpio, level, b''))
+        return self
+
+
+    def get_current_tick(self):
+        """ Queue a pi.get_current_tick(). Its result is the tick, as an unsigned int.
+        """
+        self.cmds.append((CMD_TICK, 0, 0, b''))
+        return self
+
+
+    def spi_xfer(self, handle, data):
+        """ Queue a pi.spi_xfer(handle, data). Its result is (count, rx bytes).
+        """
+        self.cmds.append((CMD_SPIX, handle, 0, bytes(data)))
+        return self
+
+
+    def run(self):
+        """ Send everything queued and return the list of results in order.
+            Raises pigpio.error if any command failed, after all the replies are in.
+        """
+        cmds, self.cmds = self.cmds, []
+        if not cmds:
+            return []
+        sock_lock = getattr(self.pig, 'sl', None)
+        if sock_lock is None:
+            return [self.one_at_a_time(cmd) for cmd in cmds]
+
+        request = bytearray()
+        for cmd, p_1, p_2, ext in cmds:
+            request += struct.pack('IIII', cmd, p_1, p_2, len(ext))
+            request += ext
+        results = []
+        with sock_lock.l:
+            sock_lock.s.sendall(request)
+            for cmd, _, _, _ in cmds:
+                res = struct.unpack('12si', self.recv(sock_lock.s, 16))[1]
+                if cmd == CMD_SPIX:
+                    res = (res, self.recv(sock_lock.s, res) if res > 0 else b'')
+                results.append(res)
+        for cmd, res in zip([cmd[0] for cmd in cmds], results):
+            code = res[0] if isinstance(res, tuple) else res
+            if code < 0 and cmd != CMD_TICK:
+                raise pigpio.error(pigpio.error_text(code))
+        results = [res & 0xFFFFFFFF if cmd[0] == CMD_TICK else res
+                   for cmd, res in zip(cmds, results)]
+        return results
+
+
+    def one_at_a_time(self, cmd):
+        cmd, p_1, p_2, ext = cmd
+        if cmd == CMD_SPIX:
+            return getattr(self.pig, METHODS[cmd])(p_1, ext)
+        if cmd == CMD_READ:
+            return getattr(self.pig, METHODS[cmd])(p_1)
+        if cmd == CMD_TICK:
+            return getattr(self.pig, METHODS[cmd])()
+        return getattr(self.pig, METHODS[cmd])(p_1, p_2)
+
+
+    @staticmethod
+    def recv(sock, count):
+        """ Read exactly count bytes from the daemon.
+        """
+        data = bytearray()
+        while len(data) < count:
+            chunk = sock.recv(count - len(data))
+            if not chunk:
+                raise pigpio.error('pigpio socket closed')
+            data += chunk
+        return bytes(data)
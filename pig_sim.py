@@ -0,0 +1,573 @@
+#!/usr/bin/env python3
+"""pig_sim.py
+   A pretend pigpio daemon with a virtual clock, so IrReceiver, SpiVolume and
+   CaptureEncoder can run on any Linux box.
+
+   PigSim listens on a TCP port and answers the pigpio socket commands our classes send:
+   modes, pull ups, read, write, watchdogs, glitch filters, callbacks (notification
+   handles), SPI and the script calls CaptureEncoder makes. Connect the real pigpio
+   library to it with pigpio.pi('localhost', port).
+
+   Time is virtual: the tick runs --speed times faster than the real clock. Scripted
+   level changes (IR transmissions, water meter turns) are queued at virtual times and
+   reported with exactly those ticks however late the simulator gets to them, so a
+   thousand key presses take seconds and still decode. Watchdogs and glitch filters
+   work like the daemon's, in virtual time. The tick starts 10 s (virtual) short of
+   wrapping around so every long run crosses it.
+
+   Not simulated: stored scripts are accepted and report running, but don't run (no
+   heartbeat LED), and there is no /dev/pigpio<handle> pipe for ir_rx --bulk.
+
+   pig_sim load runs remote_control's receiver and volume control (and a water meter)
+   against it with random key presses and checks what comes out the other end. The
+   clients run on the real clock, so anything they take time over (cancelling a
+   watchdog, the SPI writer's --interval) looks --speed times slower. If the report
+   shows the scheduler running a long way late, or lots of watchdog timeouts, the
+   speed is more than this box can keep up with.
+"""
+
+import heapq
+import itertools
+import os
+import random
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+import pigpio
+
+from ir_protocols import PROTOCOLS, CODE, REPEAT
+
+usage_text = """
+ Usage:
+  pig_sim  serve [--port <P>] [--speed <X>] [--verbose]
+  pig_sim  load [--port <P>] [--speed <X>] [--presses <N>] [--meter <M>] [--seed <S>] [--verbose]
+  pig_sim -h | --help
+
+ Options:
+  -h --help               Show this screen.
+  -p --port <P>           TCP port, use pigpio.pi('localhost', P) [default: 8889]
+  -x --speed <X>          Virtual us per real us [default: 100]
+  -n --presses <N>        Key presses in the load test [default: 1000]
+  -e --meter <M>          Water meter changes in the load test [default: 100]
+  -s --seed <S>           Random seed for the load test [default: 1]
+  -v --verbose            Print stuff
+    """
+
+# pigpio socket command numbers (the _PI_CMD_* values in pigpio.py)
+CMD_MODES = 0
+CMD_PUD = 2
+CMD_READ = 3
+CMD_WRITE = 4
+CMD_WDOG = 9
+CMD_BR1 = 10
+CMD_TICK = 16
+CMD_HWVER = 17
+CMD_NB = 19
+CMD_NC = 21
+CMD_PROC = 38
+CMD_PROCD = 39
+CMD_PROCR = 40
+CMD_PROCS = 41
+CMD_PROCP = 45
+CMD_SPIO = 71
+CMD_SPIC = 72
+CMD_SPIX = 75
+CMD_FG = 97
+CMD_NOIB = 99
+
+HARDWARE_REVISION = 0xa02082        # a Pi 3 B
+IDLE_LEVELS = 1 << 2 | 1 << 3       # SDA and SCL have pull ups on the board
+TICK_MASK = 0xFFFFFFFF
+START_TICK = TICK_MASK + 1 - 10000000
+REPEAT_US = 108000                  # NEC sends a repeat code this often while a key is held
+
+
+class PigSim():
+    """ A pigpio daemon on a TCP port with a virtual clock.
+            sim = PigSim(8889, speed=100)
+            sim.start()
+            rcvr = IrReceiver(pigpio.pi('localhost', 8889), **opts)
+            end = sim.ir(3, 122, 26, repeats=2)     # hold volume up for 3 codes
+            sim.wait(end + 50000)
+        Virtual times are us, not wrapped. Reports carry them as 32 bit ticks.
+    """
+
+    def __init__(self, port=8889, speed=100.0, levels=IDLE_LEVELS, start_tick=START_TICK):
+        self.port = port
+        self.speed = float(speed)
+        self.levels = levels        # bank 1 as reported, after the glitch filters
+        self.raw = levels           # bank 1 as driven
+        self.modes = {}
+        self.glitch = {}            # gpio -> steady us
+        self.pending = {}           # gpio -> generation of the change the filter is holding
+        self.watchdog = {}          # gpio -> [ms, generation, us it counts from]
+        self.last_edge = {}         # gpio -> us of its last reported change
+        self.handles = {}           # notification handle -> [socket, gpio bits, seqno, reports]
+        self.spi = {}               # handle -> (channel, baud, flags)
+        self.scripts = {}           # id -> status
+        self.events = []            # heap of (us, seq, func, args)
+        self.seq = itertools.count()
+        self.new_ids = itertools.count()
+        self.cond = threading.Condition()
+        self.virt0 = start_tick
+        self.real0 = time.perf_counter()
+        self.paused = None          # the virtual time it stopped at
+        self.running = False
+        self.listener = None
+        self.verbose = False
+        # what happened, for the load test
+        self.n_edges = 0            # scripted level changes
+        self.n_reports = 0          # level change reports sent to callbacks
+        self.wd_gaps = []           # us from the last edge to each watchdog report
+        self.behind_us = 0          # most an event fired after its time
+        self.spi_log = []           # (us, handle, data)
+        self.write_log = []         # (us, gpio, level)
+
+
+    def clock(self):
+        """ Virtual time by the real clock.
+        """
+        if self.paused is not None:
+            return self.paused
+        return self.virt0 + int((time.perf_counter() - self.real0) * 1e6 * self.speed)
+
+
+    def now(self):
+        """ Virtual time, held back to the next event if run_loop() is behind so the
+            commands a client sends are never stamped after reports it hasn't had yet.
+        """
+        now = self.clock()
+        if self.events and self.events[0][0] < now:
+            return self.events[0][0]
+        return now
+
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('localhost', self.port))
+        self.listener.listen(8)
+        self.real0 = time.perf_counter()
+        self.running = True
+        for target in (self.accept_loop, self.run_loop):
+            threading.Thread(target=target, name='pig_sim', daemon=True).start()
+
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+            socks = [handle[0] for handle in self.handles.values()]
+        self.listener.close()
+        for sock in socks:
+            sock.close()
+
+
+    def pause(self):
+        """ Stop the virtual clock, e.g. while queueing a lot of events.
+        """
+        with self.cond:
+            if self.paused is None:
+                self.paused = self.clock()
+
+
+    def resume(self):
+        with self.cond:
+            if self.paused is not None:
+                self.virt0, self.real0 = self.paused, time.perf_counter()
+                self.paused = None
+                self.cond.notify_all()
+
+
+    def schedule(self, us, func, *args):
+        heapq.heappush(self.events, (us, next(self.seq), func, args))
+
+
+    def script(self, gpio, widths, at=None, level=0):
+        """ Drive gpio to level at virtual time at (default 1 ms from now), then flip it
+            after each width in us. Returns the time of the last change.
+        """
+        with self.cond:
+            us = self.now() + 1000 if at is None else at
+            self.schedule(us, self.edge, gpio, level, us)
+            for width in widths:
+                us += width
+                level ^= 1
+                self.schedule(us, self.edge, gpio, level, us)
+            self.cond.notify()
+        return us
+
+
+    def ir(self, gpio, address, command, protocol='nec', repeats=0, at=None):
+        """ An IR receiver output on gpio (low while it sees a burst) for one key press:
+            a transmission then repeats codes, the whole thing again for protocols
+            without one. Returns the time of the last edge.
+        """
+        proto = PROTOCOLS[protocol](0)
+        frame = proto.encode(address, command)
+        again = proto.encode_repeat() or frame
+        at = self.now() + 1000 if at is None else at
+        end = self.script(gpio, frame, at)
+        for i in range(1, repeats + 1):
+            end = self.script(gpio, again, at + i * REPEAT_US)
+        return end
+
+
+    def meter(self, gpio, n_changes, period_us, at=None, bounce_us=0):
+        """ n_changes water meter turns on gpio, period_us apart. With bounce_us each
+            change bounces back and forth once before it settles.
+        """
+        with self.cond:
+            at = self.now() + 1000 if at is None else at
+            level = 0 if (self.raw >> gpio) & 1 else 1
+            for i in range(n_changes):
+                self.script(gpio, [bounce_us, bounce_us] if bounce_us else [],
+                            at + i * period_us, level)
+                level ^= 1
+        return at + (n_changes - 1) * period_us
+
+
+    def wait(self, until):
+        """ Block until virtual time until has come and everything up to it has fired.
+        """
+        with self.cond:
+            while self.running:
+                now = self.clock()
+                if now >= until and not (self.events and self.events[0][0] <= until):
+                    return
+                self.cond.wait(max((until - now) / self.speed * 1e-6, 0.001))
+
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:         # stop() closed it
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.serve, args=(conn,), name='pig_sim', daemon=True).start()
+
+
+    def serve(self, conn):
+        """ Answer one pigpio.pi() socket. The one it sends NOIB on becomes a
+            notification stream; after that only run_loop() writes to it.
+        """
+        handle = None
+        while True:
+            head = recv_all(conn, 16)
+            if len(head) < 16:
+                break
+            cmd, p1, p2, p3 = struct.unpack('IIII', head)
+            ext = recv_all(conn, p3) if p3 else b''
+            with self.cond:
+                if cmd == CMD_NOIB:
+                    handle = res = next(self.new_ids)
+                    self.handles[handle] = [conn, 0, 0, bytearray()]
+                    extra = b''
+                elif handle is not None:    # the notification socket only ever says NC
+                    break
+                else:
+                    res, extra = self.command(cmd, p1, p2, ext)
+                self.cond.notify()
+            if self.verbose and cmd in (CMD_WRITE, CMD_SPIX):
+                print('%08x'%(self.now() & TICK_MASK,), 'write' if cmd == CMD_WRITE else 'spi',
+                      p1, p2 if cmd == CMD_WRITE else ext.hex())
+            try:
+                conn.sendall(struct.pack('IIII', cmd, p1, p2, res & TICK_MASK) + extra)
+            except OSError:
+                break
+        with self.cond:
+            self.handles.pop(handle, None)
+        conn.close()
+
+
+    def command(self, cmd, p1, p2, ext):
+        """ Do one command (holding self.cond). Returns (result, extra reply bytes).
+        """
+        if cmd in (CMD_MODES, CMD_PUD, CMD_READ, CMD_WRITE, CMD_WDOG, CMD_FG) and p1 > 31:
+            return pigpio.PI_BAD_USER_GPIO, b''
+        now = self.now()
+        res, extra = 0, b''
+        if cmd == CMD_MODES:
+            self.modes[p1] = p2
+        elif cmd == CMD_PUD:
+            if p2 != pigpio.PUD_OFF and self.modes.get(p1, pigpio.INPUT) == pigpio.INPUT:
+                self.drive(p1, 1 if p2 == pigpio.PUD_UP else 0, now)
+        elif cmd == CMD_READ:
+            res = (self.levels >> p1) & 1
+        elif cmd == CMD_WRITE:
+            self.write_log.append((now, p1, p2))
+            self.drive(p1, 1 if p2 else 0, now)
+        elif cmd == CMD_WDOG:
+            self.set_watchdog(p1, p2, now)
+        elif cmd == CMD_BR1:
+            res = self.levels
+        elif cmd == CMD_TICK:
+            res = now
+        elif cmd == CMD_HWVER:
+            res = HARDWARE_REVISION
+        elif cmd in (CMD_NB, CMD_NC):
+            if p1 not in self.handles:
+                return pigpio.PI_BAD_HANDLE, b''
+            if cmd == CMD_NB:
+                self.handles[p1][1] = p2
+            else:
+                self.handles.pop(p1)[0].shutdown(socket.SHUT_RDWR)
+        elif cmd == CMD_FG:
+            self.glitch[p1] = p2
+        elif cmd == CMD_SPIO:
+            res = next(self.new_ids)
+            self.spi[res] = (p1, p2, struct.unpack('I', ext)[0])
+        elif cmd in (CMD_SPIC, CMD_SPIX):
+            if p1 not in self.spi:
+                return pigpio.PI_BAD_HANDLE, b''
+            if cmd == CMD_SPIC:
+                del self.spi[p1]
+            else:
+                self.spi_log.append((now, p1, ext))
+                res, extra = len(ext), bytes(len(ext))
+        elif cmd == CMD_PROC:
+            res = next(self.new_ids)
+            self.scripts[res] = pigpio.PI_SCRIPT_HALTED
+        elif cmd in (CMD_PROCR, CMD_PROCS, CMD_PROCD, CMD_PROCP):
+            if p1 not in self.scripts:
+                return pigpio.PI_BAD_SCRIPT_ID, b''
+            if cmd == CMD_PROCR:
+                self.scripts[p1] = pigpio.PI_SCRIPT_RUNNING
+            elif cmd == CMD_PROCS:
+                self.scripts[p1] = pigpio.PI_SCRIPT_HALTED
+            elif cmd == CMD_PROCD:
+                del self.scripts[p1]
+            else:
+                extra = struct.pack('11i', self.scripts[p1], *[0] * 10)
+                res = len(extra)
+        else:
+            res = pigpio.PI_UNKNOWN_COMMAND
+        return res, extra
+
+
+    def edge(self, gpio, level, us):
+        self.n_edges += 1
+        self.drive(gpio, level, us)
+
+
+    def drive(self, gpio, level, us):
+        """ gpio is driven to level at us. Report it now, or when it has been
+            steady for the glitch filter time.
+        """
+        bit = 1 << gpio
+        if bool(self.raw & bit) == bool(level):
+            return
+        self.raw ^= bit
+        steady = self.glitch.get(gpio)
+        if not steady:
+            self.report(gpio, us)
+            return
+        generation = self.pending.get(gpio, 0) + 1      # drops any change being held
+        self.pending[gpio] = generation
+        if (self.raw ^ self.levels) & bit:
+            self.schedule(us + steady, self.settle, gpio, generation, us)
+
+
+    def settle(self, gpio, generation, us):
+        if self.pending.get(gpio) == generation:
+            self.report(gpio, us)       # with the tick of the change, like the daemon
+
+
+    def report(self, gpio, us):
+        bit = 1 << gpio
+        self.levels = (self.levels & ~bit) | (self.raw & bit)
+        self.last_edge[gpio] = us
+        record_for = lambda handle: struct.pack('HHII', handle[2], 0, us & TICK_MASK, self.levels)
+        self.notify(bit, record_for)
+        watchdog = self.watchdog.get(gpio)
+        if watchdog:
+            watchdog[1] = next(self.seq)
+            watchdog[2] = us
+            self.schedule(us + watchdog[0] * 1000, self.bark, gpio, watchdog[1])
+
+
+    def notify(self, bit, record_for):
+        """ Queue a report for every handle watching bit. run_loop() sends them.
+        """
+        for handle in self.handles.values():
+            if handle[1] & bit:
+                handle[3] += record_for(handle)
+                handle[2] = (handle[2] + 1) & 0xFFFF
+                self.n_reports += 1
+
+
+    def set_watchdog(self, gpio, timeout_ms, now):
+        self.watchdog.pop(gpio, None)
+        if timeout_ms:
+            generation = next(self.seq)
+            self.watchdog[gpio] = [timeout_ms, generation, now]
+            self.schedule(now + timeout_ms * 1000, self.bark, gpio, generation)
+
+
+    def bark(self, gpio, generation):
+        """ No change on gpio for its watchdog time. Again every time until cancelled.
+        """
+        watchdog = self.watchdog.get(gpio)
+        if not watchdog or watchdog[1] != generation:
+            return
+        us = watchdog[2] + watchdog[0] * 1000
+        self.wd_gaps.append(us - self.last_edge.get(gpio, us))
+        flags = pigpio.NTFY_FLAGS_WDOG | gpio
+        self.notify(1 << gpio,
+                    lambda handle: struct.pack('HHII', handle[2], flags, us & TICK_MASK, self.levels))
+        watchdog[2] = us
+        self.schedule(us + watchdog[0] * 1000, self.bark, gpio, generation)
+
+
+    def run_loop(self):
+        """ Fire events as their virtual time comes and send the reports they make.
+        """
+        while True:
+            with self.cond:
+                while self.running:
+                    if any(handle[3] for handle in self.handles.values()):
+                        break
+                    if self.events:
+                        wait_us = self.events[0][0] - self.clock()
+                        if wait_us <= 0:
+                            break
+                        self.cond.wait(wait_us / self.speed * 1e-6)
+                    else:
+                        self.cond.wait()
+                if not self.running:
+                    return
+                now = self.clock()
+                while self.events and self.events[0][0] <= now:
+                    us, _, func, args = heapq.heappop(self.events)
+                    self.behind_us = max(self.behind_us, now - us)
+                    func(*args)
+                outbox = []
+                for handle in self.handles.values():
+                    if handle[3]:
+                        outbox.append((handle[0], bytes(handle[3])))
+                        handle[3] = bytearray()
+                self.cond.notify_all()      # for wait()
+            for sock, data in outbox:
+                try:
+                    sock.sendall(data)
+                except OSError:
+                    pass
+
+
+def recv_all(conn, n_bytes):
+    data = b''
+    while len(data) < n_bytes:
+        try:
+            more = conn.recv(n_bytes - len(data))
+        except OSError:
+            more = b''
+        if not more:
+            break
+        data += more
+    return data
+
+
+def load_test(opts):
+    """ Press random keymap keys at remote_control's receiver and turn the water meter,
+        then see that every code was decoded and the SPI and mute pin ended up where
+        SpiVolume thinks they are.
+        opts is a dict of command line options
+    """
+    import remote_control
+    from capture_encoder import CaptureEncoder
+
+    rng = random.Random(int(opts['--seed']))
+    sim = PigSim(int(opts['--port']), float(opts['--speed']))
+    sim.verbose = opts['--verbose']
+    sim.start()
+    tmp_dir = tempfile.mkdtemp(prefix='pig_sim')
+    pig, spi_vol, rcvr = remote_control.init_devs(pigpio.pi('localhost', sim.port),
+                                                  os.path.join(tmp_dir, 'state.txt'))
+    threading.Thread(target=remote_control.forever, args=(spi_vol, rcvr), daemon=True).start()
+    encoder = CaptureEncoder(pig, {'--file': os.path.join(tmp_dir, 'waterlog.txt'),
+                                   '--meter': 4, '--led': 15, '--heartbeat': 1.0,
+                                   '--verbose': 0, '--debounce': 0.09})
+    encoder.start()
+
+    keys = sorted(spi_vol.table)
+    n_presses = int(opts['--presses'])
+    n_repeats = n_heard = 0     # a repeat code is only heard if it starts over --pre after the code before
+    sim.pause()
+    at = start = sim.now() + 100000
+    for _ in range(n_presses):
+        protocol, address, command = rng.choice(keys)
+        repeats = rng.choice((0, 0, 1, 3))
+        n_repeats += repeats
+        if repeats:
+            proto = PROTOCOLS[protocol](0)
+            again = proto.encode_repeat() or proto.encode(address, command)
+            n_heard += REPEAT_US - sum(proto.encode(address, command)) > rcvr.pre_us
+            n_heard += (repeats - 1) * (REPEAT_US - sum(again) > rcvr.pre_us)
+        at = sim.ir(rcvr.pin_ir, address, command, protocol, repeats, at) + \
+             rng.randint(100000, 300000)
+    n_meter = int(opts['--meter'])
+    if n_meter:
+        sim.meter(encoder.meter_gpio, n_meter, (at - start) // n_meter, start, bounce_us=2000)
+    t_start = time.perf_counter()
+    sim.resume()
+    sim.wait(at)
+    deadline = time.perf_counter() + 10
+    while time.perf_counter() < deadline and spi_vol.pending():
+        time.sleep(0.05)            # the --interval writer ramps at real speed
+    time.sleep(0.2)
+    t_elapsed = time.perf_counter() - t_start
+
+    counts = rcvr.counts
+    last_spi = sim.spi_log[-1][2] if sim.spi_log else b''
+    mute_level = (sim.levels >> spi_vol.mute_pin_bar) & 1
+    gaps = sorted(sim.wd_gaps) or [0]
+    print('%d presses, %d repeats: %.1f s virtual in %.1f s real'%(
+        n_presses, n_repeats, (at - start) * 1e-6, t_elapsed))
+    print('edges: %d scripted, %d reported, %d seen by the callback, %.0f/s'%(
+        sim.n_edges, sim.n_reports, rcvr.edges_seen, rcvr.edges_seen / t_elapsed))
+    print('decoded:', ', '.join('%s %d'%item for item in counts.items() if item[1]),
+          '(%d repeats start over --pre after the code before)'%(n_heard,))
+    print('watchdog: %d timeouts, %.1f ms median, %.1f to %.1f ms after the last edge'%(
+        len(sim.wd_gaps), gaps[len(gaps) // 2] * 1e-3, gaps[0] * 1e-3, gaps[-1] * 1e-3))
+    print('scheduler: up to %.1f ms (virtual) late'%(sim.behind_us * 1e-3,))
+    print('spi: %d transfers, last %s, gain %d; mute pin %d, %s'%(
+        len(sim.spi_log), last_spi.hex(), spi_vol.gain, mute_level,
+        'muted' if spi_vol.muted else 'unmuted'))
+    print('meter: %d changes, %d counted'%(n_meter, encoder.total_ticks))
+
+    passed = counts[CODE] == n_presses and counts[REPEAT] == n_heard and \
+             last_spi == spi_vol.frame() and \
+             mute_level == (0 if spi_vol.muted else 1) and encoder.total_ticks == n_meter
+    print('PASS' if passed else 'FAIL')
+    rcvr.cb_func.cancel()
+    encoder.stop()
+    pig.stop()
+    sim.stop()
+    return passed
+
+
+def serve(opts):
+    """ Just be a daemon until ^C, e.g. for PIGPIO_PORT=8889 ./spi_volume.py
+        opts is a dict of command line options
+    """
+    sim = PigSim(int(opts['--port']), float(opts['--speed']))
+    sim.verbose = opts['--verbose']
+    sim.start()
+    print('pigpio simulator on port %d'%(sim.port,))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    import docopt
+    opts = docopt.docopt(usage_text, version='0.0.3')
+    if opts['load']:
+        raise SystemExit(0 if load_test(opts) else 1)
+    serve(opts)
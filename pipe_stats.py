@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+""" pipe_stats.py
+    Counters and latency histograms for the IR -> volume pipeline, in the Prometheus
+    text format.
+
+    Recording has to be cheap because some of it happens on pigpio's callback thread.
+    Counters stay plain ints on IrReceiver and SpiVolume and are only read when somebody
+    asks: each one registers a collector with add_collector(). Histograms have fixed
+    buckets and observe() is a bisect and three adds.
+
+    The pipeline stages, each a histogram:
+        ir_edge_to_decode_seconds   last edge of a transmission to its decode, in daemon
+                                    ticks. About --post in buffered mode, 0 with --stream
+        ir_decode_to_write_seconds  decode to the SpiVolume.write() it caused (queue,
+                                    consumer and --interval writer thread)
+        spi_write_seconds           SpiVolume.write() until the daemon says the SPI
+                                    transfer is done
+
+    The decode to write stage crosses threads. IrReceiver.post() calls begin() on it
+    and SpiVolume.write() calls end(), which only observes if a begin() is pending, so a
+    slewed ramp of writes counts once. cancel() drops a begin() that won't get a write.
+
+    Read it either way:
+        write_textfile('/var/lib/node_exporter/textfile/ir_rx.prom', 15)  # node_exporter
+        serve('/tmp/ir_rx.stats')           # then: ./pipe_stats.py /tmp/ir_rx.stats
+"""
+
+from bisect import bisect_left
+import os
+import socket
+import threading
+import time
+
+usage_text = """
+ Usage:
+  pipe_stats  <S>
+  pipe_stats -h | --help
+
+ Options:
+  -h --help               Show this screen.
+
+ Print the stats from a running remote_control.py's socket <S>.
+    """
+
+# bucket upper bounds in us: 50 us to 1 s, roughly 1-2-5
+BOUNDS_US = (50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000,
+             100000, 200000, 500000, 1000000)
+
+
+def sample(value):
+    """ A sample value in full: %g would round a counter past 999999.
+    """
+    if isinstance(value, float):
+        if value != value or value in (float('inf'), float('-inf')):
+            return {'nan': 'NaN', 'inf': '+Inf', '-inf': '-Inf'}[repr(value)]
+        return repr(value)
+    return '%d'%(value,)
+
+
+class Histogram():
+    """ A latency histogram in us, rendered in seconds like Prometheus likes.
+    """
+
+    def __init__(self, name, help_text, bounds_us=BOUNDS_US):
+        self.name = name
+        self.help_text = help_text
+        self.bounds_us = bounds_us
+        self.counts = [0] * (len(bounds_us) + 1)    # the last is +Inf
+        self.sum_us = 0
+        self.n_observed = 0
+        self.started = None     # perf_counter() of a pending begin()
+
+
+    def observe(self, us):
+        self.counts[bisect_left(self.bounds_us, us)] += 1
+        self.sum_us += us
+        self.n_observed += 1
+
+
+    def begin(self):
+        """ Start timing a stage that ends on another thread. A newer begin() wins.
+        """
+        self.started = time.perf_counter()
+
+
+    def end(self):
+        """ Observe the time since a pending begin(), if there is one.
+        """
+        started, self.started = self.started, None
+        if started is not None:
+            self.observe((time.perf_counter() - started) * 1e6)
+
+
+    def cancel(self):
+        self.started = None
+
+
+    def render(self):
+        lines = ['# HELP %s %s'%(self.name, self.help_text), '# TYPE %s histogram'%(self.name,)]
+        total = 0
+        for bound_us, count in zip(self.bounds_us, self.counts):
+            total += count
+            lines.append('%s_bucket{le="%g"} %d'%(self.name, bound_us * 1e-6, total))
+        lines.append('%s_bucket{le="+Inf"} %d'%(self.name, self.n_observed))
+        lines.append('%s_sum %s'%(self.name, sample(self.sum_us * 1e-6)))
+        lines.append('%s_count %d'%(self.name, self.n_observed))
+        return lines
+
+
+class Stats():
+    """ Every histogram and collector in the process. Use the module functions.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+
+    def histogram(self, name, help_text):
+        with self.lock:
+            hist = self.histograms.get(name)
+            if not hist:
+                hist = self.histograms[name] = Histogram(name, help_text)
+        return hist
+
+
+    def add_collector(self, func):
+        with self.lock:
+            self.collectors.append(func)
+
+
+    def render(self):
+        """ Everything in the Prometheus text format.
+        """
+        with self.lock:
+            collectors = list(self.collectors)
+            histograms = list(self.histograms.values())
+        metrics = {}    # name -> (kind, help, samples). Several collectors can share a name
+        for func in collectors:
+            for name, kind, help_text, samples in func():
+                metrics.setdefault(name, (kind, help_text, []))[2].extend(samples)
+        lines = []
+        for name, (kind, help_text, samples) in metrics.items():
+            lines.append('# HELP %s %s'%(name, help_text))
+            lines.append('# TYPE %s %s'%(name, kind))
+            for labels, value in samples:
+                lines.append('%s{%s} %s'%(name, labels, sample(value)) if labels else
+                             '%s %s'%(name, sample(value)))
+        for hist in histograms:
+            lines.extend(hist.render())
+        return '\n'.join(lines) + '\n'
+
+
+_stats = Stats()
+
+
+def histogram(name, help_text):
+    """ The shared Histogram called name, made on first use.
+    """
+    return _stats.histogram(name, help_text)
+
+
+def add_collector(func):
+    """ func() returns a list of (name, 'counter' or 'gauge', help, [(labels, value)...])
+        where labels is '' or e.g. 'status="code"'. It's called on each render().
+    """
+    _stats.add_collector(func)
+
+
+def render():
+    return _stats.render()
+
+
+def write_textfile(file_name, interval=0):
+    """ Write the stats to file_name for node_exporter's textfile collector. The file
+        is replaced atomically so a scrape never sees half of it.
+        With an interval (s) a daemon thread keeps doing it.
+    """
+    def write_once():
+        tmp_name = file_name + '.tmp'
+        with open(tmp_name, 'w') as fout:
+            fout.write(render())
+        os.replace(tmp_name, file_name)
+
+    def write_loop():
+        while True:
+            time.sleep(interval)
+            try:
+                write_once()
+            except OSError as err:
+                print('pipe_stats:', file_name, err)
+
+    write_once()
+    if interval:
+        threading.Thread(target=write_loop, name='pipe_stats', daemon=True).start()
+
+
+def serve(socket_path):
+    """ Answer each connection to the Unix socket socket_path with the stats, from a
+        daemon thread.
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(2)
+
+    def serve_loop():
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    conn.sendall(render().encode())
+                except OSError:
+                    pass        # they hung up
+
+    threading.Thread(target=serve_loop, name='pipe_stats', daemon=True).start()
+    return server
+
+
+def read_socket(socket_path):
+    """ Fetch the stats from a process that called serve().
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b''.join(chunks).decode()
+
+
+# the pipeline stages, see the notes above
+EDGE_TO_DECODE = histogram('ir_edge_to_decode_seconds',
+                           'Last edge of a transmission to its decode (daemon ticks)')
+DECODE_TO_WRITE = histogram('ir_decode_to_write_seconds',
+                            'IR decode to the SpiVolume.write() it caused')
+SPI_WRITE = histogram('spi_write_seconds', 'SpiVolume.write() to SPI transfer complete')
+
+
+if __name__ == '__main__':
+    import docopt
+    opts = docopt.docopt(usage_text, version='0.0.3')
+    print(read_socket(opts['<S>']), end='')
@@ -2,12 +2,20 @@
 """remote_control.py
    be a remote volume control
 """
-import time
+import os
+import signal
+import sys
+
 import pigpio
+from log_sink import flush_logs
+import pipe_stats
 from spi_volume import SpiVolume
 from ir_rx import IrReceiver
 
-def init_devs(pig=None):
+STATS_SOCKET = '/tmp/ir_rx.stats'    # ./pipe_stats.py /tmp/ir_rx.stats to see how it's doing
+STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'volume_state.txt')
+
+def init_devs(pig=None, state_file=STATE_FILE):
     """init the ir receiver and the volume control
     """
     if not pig:
@@ -16,7 +24,12 @@ def init_devs(pig=None):
     spi_vol = SpiVolume(pig, **{'--baud': 500,
                                 # '--mute': 25,
                                 '--init': 180, # init at -95 + 180 * 0.5 dB = -5 dB
+                                '--interval': 20,  # ms. SPI writes on their own thread
+                                '--slew': 2,   # 1 dB per write
+                                '--state': state_file,  # come back at the same volume
                                 # '--file': '',  # '/home/pi/ir_rx/ir_vol.txt',
+                                # '--keymap': '',  # '/home/pi/ir_rx/keymap.txt', see keymap.py
+                                # '--zones': 1,  # daisy chained PGA2311s
                                 # '--verbose': False,
                                 # '--address': 122,
                                })
@@ -26,25 +39,34 @@ def init_devs(pig=None):
                               '--pre': 50,
                               '--file': '',
                               '--post': 15,
+                              '--protocols': 'nec', # e.g. 'nec,samsung,tivo'
                               '--raw': '',
                               '--short': 2,        # ignore codes w/ < 2 events
+                              '--stream': True,    # decode each edge as it arrives
                               '--tolerance': 15,   # percent deviation from expected periods
                               '--verbose': False,
                              })
+    rcvr.no_repeat = spi_vol.no_repeat     # the keymap says which keys repeat
     return pig, spi_vol, rcvr
 
 
 def forever(spi_vol, rcvr):
-    """Loop forever, passing ir commands from the ir receiver to the volume control
+    """Loop forever, passing ir commands from the ir receiver to the volume control.
+       wait_commands() sleeps until the receiver posts a code so there's no polling.
     """
-    while True:
-        # each time we rx a complete code, we stop looking
-        rcvr.look_for_a_code = True     # keep telling the IrReceiver to look
-        for a_cmd in rcvr.get_commands():
-            # print(a_cmd)                # tuple of (address, data)
-            spi_vol.write_command(a_cmd)
-        time.sleep(0.05)
+    for a_cmd in rcvr.wait_commands():
+        # print(a_cmd)                # tuple of (address, data)
+        spi_vol.write_command(a_cmd)
 
 if __name__ == '__main__':
+    # irdaemon.sh stops us with SIGTERM, which would skip the cleanup below and atexit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     pig, spi_vol, rcvr = init_devs()
-    forever(spi_vol, rcvr)
+    pipe_stats.serve(STATS_SOCKET)
+    try:
+        forever(spi_vol, rcvr)
+    finally:
+        rcvr.cb_func.cancel()
+        spi_vol.close()
+        flush_logs()        # the last volume state and log lines
+        pig.stop()
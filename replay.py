@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""replay.py
+   Feed --raw captures from ir_rx.py back through IrReceiver, no pigpio daemon needed.
+
+   Each captured transmission is turned back into callback edges (and a watchdog
+   timeout if the receiver asked for one) so the real cbf() and decode path run,
+   just as fast as the CPU allows. Good for checking a decoder change against a pile
+   of captures from the living room.
+"""
+
+import time
+
+import pigpio
+
+from ir_rx import IrReceiver, read_raw, STATUSES
+
+usage_text = """
+ Usage:
+  replay  [--adaptive] [--gap <G>] [--protocols <P>] [--stream] [--tolerance <T>] [--verbose] <R>...
+  replay -h | --help
+
+ Options:
+  -h --help               Show this screen.
+  -a --adaptive           Retry rejected frames at the remote's own timing
+  -g --gap <G>            Idle time in ms before each transmission [default: 100]
+  -p --protocols <P>      Comma list from nec,nec-ext,samsung,tivo,rc5,rc6 [default: nec]
+  -m --stream             Use the streaming decoder
+  -t --tolerance <T>      Tolerance [default: 15]
+  -v --verbose            Print stuff
+    """
+
+
+class ReplayPi():
+    """ Just enough of pigpio.pi() for IrReceiver to run without the daemon.
+        It remembers the watchdog so replay() knows when to fake a timeout.
+    """
+
+    def __init__(self):
+        self.watchdog_ms = 0
+
+    def get_hardware_revision(self):
+        return 0
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def set_glitch_filter(self, gpio, steady):
+        pass
+
+    def set_pull_up_down(self, gpio, pud):
+        pass
+
+    def callback(self, gpio, edge, func):
+        return True     # replay() calls cbf() directly
+
+    def set_watchdog(self, gpio, wdog_timeout):
+        self.watchdog_ms = wdog_timeout
+
+    def stop(self):
+        pass
+
+
+def replay(rcvr, captures, gap_us=100000):
+    """ Drive rcvr.cbf() with each list of edge widths in captures and consume the
+        commands like remote_control does. Ticks wrap at 32 bits like the daemon's.
+        Returns the number of transmissions and the number of commands.
+    """
+    cbf = rcvr.cbf
+    pin = rcvr.pin_ir
+    tick = 0
+    n_frames = n_commands = 0
+    for a_code in captures:
+        tick = (tick + gap_us) & 0xFFFFFFFF
+        cbf(pin, 0, tick)       # the burst that starts the preamble
+        level = 1
+        for width in a_code:
+            tick = (tick + width) & 0xFFFFFFFF
+            cbf(pin, level, tick)
+            level ^= 1
+        if rcvr.pig.watchdog_ms:
+            cbf(pin, pigpio.TIMEOUT, tick)
+        n_frames += 1
+        for a_cmd in rcvr.get_commands():
+            n_commands += 1
+            if rcvr.verbose:
+                print(a_cmd)
+    return n_frames, n_commands
+
+
+def main(opts):
+    """ Replay every file on the command line and report what the decoder made of it.
+        opts is a dict of command line options
+    """
+    rcvr = IrReceiver(ReplayPi(), **{'--adaptive': opts['--adaptive'],
+                                     '--protocols': opts['--protocols'],
+                                     '--stream': opts['--stream'],
+                                     '--tolerance': opts['--tolerance'],
+                                     '--verbose': opts['--verbose'],
+                                    })
+    rcvr.look_for_a_code = True
+    gap_us = int(opts['--gap']) * 1000
+
+    n_frames = n_commands = 0
+    t_start = time.perf_counter()
+    for file_name in opts['<R>']:
+        frames, commands = replay(rcvr, read_raw(file_name), gap_us)
+        n_frames += frames
+        n_commands += commands
+    t_elapsed = time.perf_counter() - t_start
+
+    print('%d frames, %d commands in %.3f s, %.0f frames/s'%(
+        n_frames, n_commands, t_elapsed, n_frames / t_elapsed if t_elapsed else 0))
+    for status in STATUSES:
+        print('  %-18s %d'%(status, rcvr.counts[status]))
+
+
+if __name__ == '__main__':
+    import docopt
+    main(docopt.docopt(usage_text, version='0.0.3'))
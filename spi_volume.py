@@ -61,20 +61,58 @@ ir_volume.py
             opts = {
                     '--address': 120,
                     '--baud': 500,
+                    '--interval': 0,
+                    '--keymap': '',
                     '--mute': 25,
+                    '--reconcile': 0,
+                    '--slew': 0,
+                    '--state': '',
                     '--verbose': False,
+                    '--zones': 1,
                    }
+
+        With --interval the SPI writes move to a writer thread. Gain changes just set a
+        target and the thread sends the latest one at most once per interval, so a burst
+        of repeat codes collapses into a few transfers and the IR consumer never waits
+        on SPI or the log file. --slew limits how far each transfer moves the gain so
+        big jumps ramp instead of zipping.
+
+        We're the only thing driving the mute pin and the gain so we keep our own copy
+        (self.pin_muted, self.sent_frame) and only talk to the daemon to write. Each pigpio
+        call is a socket round trip. --reconcile reads the pin back now and then in case
+        something else changed it.
+
+        With --state the gain and mute are kept in a one line file ('180 0') that
+        log_sink rewrites atomically a few seconds after a change. Files with the last
+        command after them, from before, still load.
+        At start we read it and send that gain before unmuting, so a restart or a power
+        cycle with the stereo comes back where it was instead of jumping to --init.
+
+        --zones N is N PGA2311s daisy chained, each chip's SDO to the next one's SDI, all
+        on CE0 and the one mute pin. A zone is one chip, zone 1 is the one on MOSI. One
+        N x 2 byte transfer sets them all: the first 16 bits clocked in end up at the far
+        end of the chain, so the bytes go out last zone first. Each zone has its own gain
+        (self.gains, a byte per zone) and mute. A muted zone is sent gain 0, which the
+        PGA2311 takes as mute, and the mute pin goes low when every zone is muted.
+        Keymap actions can name the zones they're for, see keymap.py. The state file
+        keeps a comma list of gains and of mutes.
 """
 
 from datetime import datetime
+import os
+import threading
 import time
 
-import docopt
 import pigpio
 
+from keymap import load_keymap
+from log_sink import open_log
+import pipe_stats
+from pig_batch import PigBatch
+
 usage_text = """
  Usage:
-  ir_volume  [--address <A>] [--baud <B>] [--file <F>] [--init <I>] [--mute <M>] [--verbose]
+  ir_volume  [--address <A>] [--baud <B>] [--file <F>] [--init <I>] [--interval <T>] [--keymap <C>] [--mute <M>] [--reconcile <R>] [--slew <S>] [--state <K>] [--zones <Z>] [--verbose]
   ir_volume -h | --help
 
  Options:
@@ -83,113 +121,418 @@ usage_text = """
   -b --baud <B>           The baud in kbps [default: 100]
   -f --file <F>           Log volume events to a file
   -i --init <I>           Initial volume value. [default: 200]
+  -t --interval <T>       Min ms between SPI writes, 0 writes inline [default: 0]
+  -c --keymap <C>         Keymap file, see keymap.py. Without one --address up/down/mute
   -m --mute <M>           Mute GPIO (Broadcom numbers, not J8 pins). [default: 25]
+  -r --reconcile <R>      Seconds between reads of the mute pin, 0 never reads [default: 0]
+  -s --slew <S>           Max gain change per SPI write, 0 to jump [default: 0]
+  -k --state <K>          Keep gain and mute in K and start from them instead of --init
+  -z --zones <Z>          Daisy chained PGA2311s, one per zone [default: 1]
   -v --verbose            Print stuff
     """
 
 
 class SpiVolume():
     """ A class to encapsulate the SPI controlled volume IC.
-        The NEC IR address is a c-tor option but we hard-code the key codes here
-        for volume up/down and mute.
+        IR commands are looked up in a --keymap. Without one, the Yamaha key codes
+        below at --address are volume up/down and mute.
     """
     MUTE_CODE = 28
     UP_CODE = 26
     DOWN_CODE = 27
+    PROTOCOL = 'nec'
+    KEYMAP_CHECK_S = 2.0    # how often to look for keymap changes
 
     def __init__(self, pig, **kwargs):
         self.kwargs = kwargs
         self.pig = pig
         self.my_address = int(kwargs.get('--address', 122))
+        self.keymap_file = kwargs.get('--keymap', '')
+        self.keymap_mtime = None
+        self.keymap_checked = time.monotonic()
+        self.table = {}
+        self.no_repeat = set()      # keys a repeat code shouldn't run again, for IrReceiver
         self.mute_pin_bar = int(kwargs.get('--mute', 25))
         self.log_file = kwargs.get('--file', '')
-        self.gain = int(kwargs.get('--init', 200))   # same gain is sent to L and R channels
+        self.log = open_log(self.log_file, replace=True) if self.log_file else None
+        self.zones = max(int(kwargs.get('--zones', 1)), 1)
+        self.all_zones = tuple(range(self.zones))
+        self.gains = bytearray(self.zones)  # per zone, the same gain is sent to L and R
+        self.gain = int(kwargs.get('--init', 200))
+        self.zone_muted = [False] * self.zones
         self.verbose = kwargs.get('--verbose', False)
+        self.compile_keymap()
         self.kbaud = kwargs.get('--baud', 100) * 1000
+        self.interval = abs(float(kwargs.get('--interval', 0))) * 0.001
+        self.slew = abs(int(kwargs.get('--slew', 0)))
+        self.reconcile_s = abs(float(kwargs.get('--reconcile', 0)))
+        self.reconciled = time.monotonic()
+        self.muted = False      # what we want, pin_muted is what the pin has
+        self.pin_muted = None
+        self.saved_line = None      # the last --state line queued
+        self.state_file = kwargs.get('--state', '')
+        self.state_log = open_log(self.state_file, replace=True) if self.state_file else None
+        if self.state_file:
+            self.load_state()
+        self.n_writes = 0       # SPI transfers, for pipe_stats
+        self.n_ignored = 0      # IR commands that weren't for us
 
         self.spi_ifc = pig.spi_open(0, self.kbaud, 0x00C0)
         self.pig.set_mode(self.mute_pin_bar, pigpio.OUTPUT)
-        self.mute(False)
+        self.batch = PigBatch(self.pig)
 
         if self.verbose:
             hdw_ver = self.pig.get_hardware_revision()
             print('Volume found hardware ver %06x'%(hdw_ver))
             print('  and using SPI0 at %d kbaud'%(self.kbaud//1000))
-        self.write(bytes([self.gain, self.gain,]))
+        self.sent_frame = self.frame()     # what the ICs have now
+        self.sent_gains = bytearray(self.gains)
+        self.write(self.sent_frame, b_mute=self.muted)    # one round trip
+        pipe_stats.add_collector(self.collect_stats)
+
+        self.writer = None
+        if self.interval:
+            self.cond = threading.Condition()
+            self.running = True
+            self.writer = threading.Thread(target=self.write_loop, name='spi_volume', daemon=True)
+            self.writer.start()
+
+
+    @property
+    def gain(self):
+        """ Zone 1's gain, the only one without --zones. Setting it sets every zone.
+        """
+        return self.gains[0]
+
+
+    @gain.setter
+    def gain(self, gain):
+        self.gains[:] = bytes([max(min(gain, 255), 0)]) * self.zones
+
+
+    def frame(self, gains=None):
+        """ The SPI bytes for gains (self.gains): R and L for each zone, last zone first.
+            With --zones a muted zone gets 0.
+        """
+        gains = bytearray(self.gains if gains is None else gains)
+        if self.zones > 1:
+            for zone in self.all_zones:
+                if self.zone_muted[zone]:
+                    gains[zone] = 0
+        gains.reverse()
+        data = bytearray(2 * self.zones)
+        data[0::2] = data[1::2] = gains
+        return bytes(data)
+
+
+    def write_loop(self):
+        """ The --interval writer thread. Sleeps until the gain target moves, sends one
+            transfer toward it (limited by --slew) and then holds off for the interval.
+            Whatever the target is by then is what goes next; older targets are dropped.
+        """
+        while True:
+            with self.cond:
+                while self.running and not self.pending():
+                    self.cond.wait()
+                if not self.running:
+                    return
+                gains = bytearray(self.gains)
+            if self.slew:
+                for zone, sent in enumerate(self.sent_gains):
+                    gains[zone] = max(min(gains[zone], sent + self.slew), sent - self.slew)
+            self.send(gains)
+            time.sleep(self.interval)
+
+
+    def pending(self):
+        """ True if the ICs or the mute pin aren't where we want them.
+        """
+        return self.frame() != self.sent_frame or self.muted != self.pin_muted
+
+
+    def send(self, gains=None):
+        """ Whatever differs, the frame for gains (self.gains) and the mute pin, in one
+            round trip.
+        """
+        data = self.frame(gains)
+        if data == self.sent_frame and self.muted == self.pin_muted:
+            pipe_stats.DECODE_TO_WRITE.cancel()     # pinned at the end of the range
+            return
+        self.write(data if data != self.sent_frame else None, b_mute=self.muted)
+        self.sent_frame = data
+        self.sent_gains = bytearray(self.gains if gains is None else gains)
+
 
+    def update(self):
+        """ Send the gains and mutes now, or wake the writer thread to.
+        """
+        self.save_state()
+        if self.writer:
+            if not self.pending():
+                pipe_stats.DECODE_TO_WRITE.cancel()
+            with self.cond:
+                self.cond.notify()
+        else:
+            self.send()
 
-    def write(self, data):
-        """ Send the gain word to the volume IC. data is bytes[2] suited to the
-            SPI transfer function.
+
+    def set_gain(self, gain=None):
+        """ Send self.gains (or gain, to every zone) to the ICs, now or via the writer thread.
+        """
+        if gain is not None:
+            self.gain = gain
+        self.update()
+
+
+    def close(self):
+        """ Stop the writer thread, letting it finish the transfer it's on, then send
+            whatever it hadn't got to, straight to the target without the --slew ramp.
+            The --state file already has the target, the next start begins from it.
+        """
+        if self.writer:
+            with self.cond:
+                self.running = False
+                self.cond.notify()
+            self.writer.join()
+            self.writer = None
+            self.send()
+
+
+    def write(self, data, b_mute=None):
+        """ Send the gain words to the volume ICs. data is bytes[2 * zones] suited to the
+            SPI transfer function, see frame(), or None for just the pin.
+            Pass b_mute to set the mute pin too, batched with the transfer. The pin is
+            only written if that changes it.
         """
-        data_hex = '%02X %02X'%tuple(data)
+        if b_mute is not None:
+            self.muted = bool(b_mute)
+            if self.muted == self.pin_muted:
+                b_mute = None
+        data_hex = ' '.join('%02X'%(byte,) for byte in data or b'')
         if self.verbose:
             print('write', data_hex)
-        if self.log_file:
-            with open(self.log_file, 'w') as fout:
-                mute_str = '0' if self.is_muted() else '1'
-                time_str = datetime.now().strftime('%y-%m-%d %H:%M:%S.%f')
-                fout.write('%s %s %s\n'%(mute_str, data_hex, time_str))
-
-        self.pig.spi_xfer(self.spi_ifc, data)
+        if self.log:
+            mute_str = '0' if self.is_muted() else '1'
+            time_str = datetime.now().strftime('%y-%m-%d %H:%M:%S.%f')
+            self.log.write('%s %s %s'%(mute_str, data_hex, time_str))
+
+        pipe_stats.DECODE_TO_WRITE.end()
+        t_start = time.perf_counter()
+        # one round trip: mute before the gain changes, unmute after
+        if b_mute is not None and self.muted:
+            self.batch.write(self.mute_pin_bar, 0)     # invert
+        if data:
+            self.batch.spi_xfer(self.spi_ifc, data)
+        if b_mute is not None and not self.muted:
+            self.batch.write(self.mute_pin_bar, 1)
+        self.batch.run()
+        if b_mute is not None:
+            self.pin_muted = self.muted
+        if data:
+            pipe_stats.SPI_WRITE.observe((time.perf_counter() - t_start) * 1e6)
+            self.n_writes += 1
 
 
     def mute(self, b_mute=None):
         """ When called with no arg, mute() toggles the mute state. Otherwise set mute.
-            The hardware pin is inverted (Low to mute).
+            Every zone.
         """
-        mute_bar = self.pig.read(self.mute_pin_bar)
-        if b_mute is None:
-            self.pig.write(self.mute_pin_bar, 0 if mute_bar else 1)     # toggle
-        else:
-            self.pig.write(self.mute_pin_bar, 0 if b_mute else 1)     # invert arg
+        self.muted = (not self.muted) if b_mute is None else bool(b_mute)
+        self.zone_muted = [self.muted] * self.zones
+        self.update()
+
+
+    def load_state(self):
+        """ Start from the --state file, if there's a good one.
+        """
+        try:
+            with open(self.state_file) as f_in:
+                fields = f_in.readline().split()
+            gains = [max(min(int(gain), 255), 0) for gain in fields[0].split(',')]
+            muted = [bool(int(mute)) for mute in fields[1].split(',')]
+        except (OSError, ValueError, IndexError):
+            return      # first run, or something we didn't write. Use --init
+        # a file from fewer zones: the new zones copy the last one
+        self.gains[:] = bytes((gains + gains[-1:] * self.zones)[:self.zones])
+        self.zone_muted = (muted + muted[-1:] * self.zones)[:self.zones]
+        self.muted = all(self.zone_muted)
+        if self.verbose:
+            print('restored gain', self.gain, 'muted' if self.muted else 'unmuted')
+
+
+    def save_state(self):
+        """ Queue the --state line if it changed. Only the latest is kept and written.
+        """
+        if self.state_log:
+            line = '%s %s'%(','.join('%d'%(gain,) for gain in self.gains),
+                            ','.join('%d'%(muted,) for muted in self.zone_muted))
+            if line != self.saved_line:
+                self.saved_line = line
+                self.state_log.write(line)
 
 
     def is_muted(self):
         """ Return True if the volume IC is in mute state, else False.
-            The hardware pin is inverted (Low to mute).
+            Answered from our copy, no pigpio call.
         """
-        return 0 if self.pig.read(self.mute_pin_bar) else 1 # inverted
+        return self.muted
+
+
+    def reconcile(self):
+        """ Every --reconcile seconds, read the mute pin back and believe it
+            over our copy. Returns True if it had changed behind our back.
+        """
+        now = time.monotonic()
+        if not self.reconcile_s or now - self.reconciled < self.reconcile_s:
+            return False
+        self.reconciled = now
+        muted = not self.pig.read(self.mute_pin_bar)    # inverted
+        if muted == self.muted:
+            return False
+        if self.verbose:
+            print('mute pin changed outside, now', 'muted' if muted else 'unmuted')
+        self.zone_muted = [muted] * self.zones
+        self.muted = self.pin_muted = muted
+        self.save_state()       # the gains follow with the command
+        return True
 
 
-    def add_gain(self, inc_val):
+    def add_gain(self, inc_val, zones=None):
         """Commanded to increase or decrease volume, this routine limits the
            gain value to the legal range (0 to 255).
            Also speeds up the UI slew rate by skipping evey other volume step.
         """
-        self.gain += inc_val * 2    # 1 dB steps are fine enough
-        self.gain = max(min(self.gain, 255), 0)
+        for zone in self.all_zones if zones is None else zones:
+            gain = self.gains[zone] + inc_val * 2    # 1 dB steps are fine enough
+            self.gains[zone] = max(min(gain, 255), 0)
+
+
+    # the keymap actions only change our copy, write_command() sends it
+
+    def step(self, steps, zones=None):
+        """ Keymap 'up' and 'down': steps volume steps, or unmute if we're muted.
+            zones is None for all of them.
+        """
+        zones = self.all_zones if zones is None else zones
+        if any(self.zone_muted[zone] for zone in zones):
+            self.set_mute(False, zones)
+        else:
+            self.add_gain(steps, zones)
+
+
+    def preset(self, gain, zones=None):
+        """ Keymap 'gain=g'.
+        """
+        for zone in self.all_zones if zones is None else zones:
+            self.gains[zone] = gain
+
+
+    def set_mute(self, b_mute, zones=None):
+        """ Keymap 'mute' (toggle, b_mute None), 'mute=1' and 'mute=0'.
+            Toggling zones mutes them unless they're all muted already.
+        """
+        zones = self.all_zones if zones is None else zones
+        if b_mute is None:
+            b_mute = not all(self.zone_muted[zone] for zone in zones)
+        for zone in zones:
+            self.zone_muted[zone] = bool(b_mute)
+        self.muted = all(self.zone_muted)
+
+
+    def compile_keymap(self):
+        """ Build the dispatch table:
+                (protocol, address, command) -> ((method, arg, zones), ...)
+            from the --keymap file, or the Yamaha up/down/mute keys at --address.
+            zones are indexes into self.gains, None for all of them.
+            Raises ValueError for a bad file, without touching the table.
+        """
+        if self.keymap_file:
+            self.keymap_mtime = os.stat(self.keymap_file).st_mtime
+            entries = load_keymap(self.keymap_file)
+        else:
+            yamaha = (SpiVolume.PROTOCOL, self.my_address)
+            entries = [(yamaha + (SpiVolume.UP_CODE,), [('up', 1, None)], True),
+                       (yamaha + (SpiVolume.DOWN_CODE,), [('down', 1, None)], True),
+                       (yamaha + (SpiVolume.MUTE_CODE,), [('mute', None, None)], False)]
+        methods = {'up': self.step, 'gain': self.preset, 'mute': self.set_mute,
+                   'down': lambda steps, zones: self.step(-steps, zones)}
+        table = {}
+        no_repeat = set()
+        for key, actions, repeats in entries:
+            compiled = []
+            for name, arg, zones in actions:
+                if zones is not None:
+                    if zones[-1] > self.zones:
+                        raise ValueError('%s %d %d: zone %d, there are %d'%(
+                            key + (zones[-1], self.zones)))
+                    zones = tuple(zone - 1 for zone in zones)
+                compiled.append((methods[name], arg, zones))
+            table[key] = tuple(compiled)
+            if not repeats:
+                no_repeat.add(key)
+        self.table = table
+        self.no_repeat.update(no_repeat)     # in place, IrReceiver holds a reference
+        self.no_repeat.intersection_update(no_repeat)
+
+
+    def reload_keymap(self):
+        """ Every KEYMAP_CHECK_S, recompile the --keymap file if it changed.
+        """
+        now = time.monotonic()
+        if not self.keymap_file or now - self.keymap_checked < SpiVolume.KEYMAP_CHECK_S:
+            return
+        self.keymap_checked = now
+        try:
+            if os.stat(self.keymap_file).st_mtime == self.keymap_mtime:
+                return
+            self.compile_keymap()
+        except (OSError, ValueError) as err:    # keep the old one until it's fixed
+            print('keymap %s: %s'%(self.keymap_file, err))
+            return
+        if self.verbose:
+            print('reloaded', self.keymap_file)
 
 
     def write_command(self, ir_cmd):
         """write_cmd() is called whenever we receive an IR command.
-           We only care about commands to our address
-           and we only care about 3 commands: volume up, down, and mute
+           (address, command, protocol) is looked up in the keymap and its actions run,
+           then what they changed goes out together: one SPI frame and the mute pin.
+           Returns True if it was in the keymap.
         """
-        b_handled = False     # assume un-handled
         if not ir_cmd:
-            return b_handled
-
-        if ir_cmd[0] != self.my_address:
-            pass     # ignore nec commands to another address. Flag it as un-handled
-        elif ir_cmd[1] == SpiVolume.UP_CODE:     # volume up
-            if self.is_muted():
-                self.mute(False)
-            else:
-                self.add_gain(1)
-                self.write(bytes([self.gain, self.gain,]))
-            b_handled = True     # Flag it as handled
-        elif ir_cmd[1] == SpiVolume.DOWN_CODE:   # volume down
-            if self.is_muted():
-                self.mute(False)
-            else:
-                self.add_gain(-1)
-                self.write(bytes([self.gain, self.gain,]))
-            b_handled = True     # Flag it as handled
-        elif ir_cmd[1] == SpiVolume.MUTE_CODE:   # mute (toggle)
-            self.mute()         # toggle
-            b_handled = True     # Flag it as handled
-        return b_handled
+            return False
+        self.reconcile()
+        self.reload_keymap()
+
+        key = (ir_cmd[2] if len(ir_cmd) > 2 else SpiVolume.PROTOCOL, ir_cmd[0], ir_cmd[1])
+        actions = self.table.get(key)
+        if not actions:
+            self.n_ignored += 1
+            pipe_stats.DECODE_TO_WRITE.cancel()
+            return False
+        for method, arg, zones in actions:
+            method(arg, zones)
+        self.update()
+        return True
+
+
+    def collect_stats(self):
+        """ Our counters for pipe_stats.
+        """
+        return [('spi_writes_total', 'counter', 'SPI transfers to the volume IC',
+                 [('', self.n_writes)]),
+                ('spi_ignored_commands_total', 'counter', 'IR commands not for this address',
+                 [('', self.n_ignored)]),
+                ('spi_gain', 'gauge', 'Gain last sent to the IC', self.by_zone(self.sent_gains)),
+                ('spi_muted', 'gauge', '1 if muted', self.by_zone(self.zone_muted))]
+
+
+    def by_zone(self, values):
+        """ pipe_stats samples, labelled by zone with --zones.
+        """
+        if self.zones == 1:
+            return [('', int(values[0]))]
+        return [('zone="%d"'%(zone + 1,), int(value)) for zone, value in enumerate(values)]
 
 
 def test(opts):
@@ -223,11 +566,13 @@ def test(opts):
             done = True
         time.sleep(0.1)
 
+    spi_vol.close()
     spi_vol.pig.stop() # Disconnect from Pi.
 
 
 
 if __name__ == '__main__':
+    import docopt
     opts = docopt.docopt(usage_text, version='0.0.3')
     test(opts)
     if opts['--verbose']:
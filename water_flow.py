@@ -0,0 +1,227 @@
+# water_flow.py
+# running water totals, flow rate and leak detection from CaptureEncoder meter changes
+"""Notes:
+    FlowAggregator.add() is called once per meter change (0.05 cubic foot) and does a
+    fixed amount of work: bump the count for the current minute, hour and day, and if
+    the period rolled over, file the finished one away. Nothing ever rescans the tick
+    history, so asking for today's total or the last hour by minute is just a lookup.
+
+    Finished hours and days are appended to a rollup file (through log_sink) and read
+    back at start, so the totals survive a restart: the hour and day in progress carry on
+    from their saved counts. Minutes only live in memory. `python3 water_flow.py` checks
+    that with a scratch rollup file.
+
+    The minutes, hours and days are local time so a day starts at midnight, and they're
+    numbered the same in the rollup file. When daylight saving ends the repeated hour
+    adds to the one before. The flow rate and the leak streak go by UTC, which doesn't
+    jump.
+
+    A leak looks like water running every minute for a long time. We keep a streak of
+    consecutive minutes with at least one meter change; once it's --leak minutes long
+    leak() says so until a whole minute goes by with no flow.
+"""
+
+import collections
+from datetime import datetime, timedelta
+import os
+import threading
+
+from log_sink import open_log, flush_logs
+from water_log import to_us, ONE_US, CUFT_PER_TICK, GALLONS_PER_CUFT
+
+PERIOD_US = {'minute': 60 * 10**6, 'hour': 3600 * 10**6, 'day': 86400 * 10**6}
+KEEP = {'minute': 24 * 60, 'hour': 24 * 62, 'day': 10 * 366}    # periods kept in memory
+PERSIST = ('hour', 'day')
+LOCAL_EPOCH = datetime(1970, 1, 1)
+
+usage_text = """
+ Usage:
+  water_flow  [--rollup <R>]
+  water_flow -h | --help
+
+ Options:
+  -h --help               Show this screen.
+  -r --rollup <R>         Rollup file to test with, it's deleted first [default: /tmp/rollup_test.txt]
+    """
+
+
+def local_us(when):
+    """ Local wall clock microseconds since 1970, what the periods are numbered by.
+        A naive datetime is local already.
+    """
+    if when.tzinfo is not None:
+        when = when.astimezone().replace(tzinfo=None)
+    return (when - LOCAL_EPOCH) // ONE_US
+
+
+class FlowAggregator():
+    """ Rolling per minute/hour/day totals, flow rate and a leak flag.
+            agg = FlowAggregator('/home/pi/wet/rollup.txt', leak_minutes=120)
+            agg.add(datetime.now())           # from CaptureEncoder.record()
+            agg.recent('hour', 24, datetime.now())
+        Counts are meter changes. Multiply by CUFT_PER_TICK for cubic feet.
+    """
+
+    def __init__(self, rollup_file='', leak_minutes=120):
+        self.leak_minutes = leak_minutes
+        self.lock = threading.Lock()    # add() is on the pigpio thread, queries aren't
+        self.history = {period: {} for period in PERIOD_US}     # period number -> count
+        self.order = {period: collections.deque() for period in PERIOD_US}
+        self.current = {period: None for period in PERIOD_US}   # [period number, count]
+        self.last_us = None         # the last meter change
+        self.interval_us = None     # between the last two
+        self.streak = 0             # consecutive minutes with flow
+        self.streak_minute = None   # the minute the streak was last extended
+        self.rollup = None
+        if rollup_file:
+            self.load(rollup_file)
+            self.rollup = open_log(rollup_file)
+
+
+    def load(self, rollup_file):
+        """ Read back the hours and days a previous run finished.
+        """
+        try:
+            with open(rollup_file) as f_in:
+                for line in f_in:
+                    period, number, count = line.strip().split(',')
+                    self.file_away(period, int(number), int(count))
+        except (OSError, ValueError):
+            pass        # nothing yet, or a torn last line
+
+
+    def file_away(self, period, number, count):
+        history = self.history[period]
+        if number not in history:
+            self.order[period].append(number)
+        history[number] = count
+        if len(self.order[period]) > KEEP[period]:
+            del history[self.order[period].popleft()]
+
+
+    def add(self, when):
+        """ Count one meter change at datetime when. O(1).
+        """
+        now_us = to_us(when)
+        wall_us = local_us(when)
+        with self.lock:
+            for period, period_us in PERIOD_US.items():
+                number = wall_us // period_us
+                current = self.current[period]
+                if current and current[0] == number:
+                    current[1] += 1
+                    continue
+                if current:
+                    self.file_away(period, current[0], current[1])
+                    if self.rollup and period in PERSIST:
+                        self.rollup.write('%s,%d,%d'%(period, current[0], current[1]))
+                # a restart partway through a period carries on from what load() read
+                self.current[period] = [number, self.history[period].get(number, 0) + 1]
+
+            minute = now_us // PERIOD_US['minute']
+            if minute != self.streak_minute:
+                self.streak = self.streak + 1 if self.streak_minute == minute - 1 else 1
+                self.streak_minute = minute
+
+            if self.last_us is not None:
+                self.interval_us = now_us - self.last_us
+            self.last_us = now_us
+
+
+    def flush(self):
+        """ Persist the periods in progress too, e.g. at shutdown. load() keeps the last
+            value written for a period, so writing it again later is fine.
+        """
+        with self.lock:
+            if self.rollup:
+                for period in PERSIST:
+                    if self.current[period]:
+                        self.rollup.write('%s,%d,%d'%((period,) + tuple(self.current[period])))
+
+
+    def count(self, period, when):
+        """ Meter changes in the minute, hour or day containing datetime when.
+        """
+        number = local_us(when) // PERIOD_US[period]
+        with self.lock:
+            current = self.current[period]
+            if current and current[0] == number:
+                return current[1]
+            return self.history[period].get(number, 0)
+
+
+    def recent(self, period, n_periods, when):
+        """ Counts for the n_periods periods up to and including the one containing when,
+            oldest first.
+        """
+        last = local_us(when) // PERIOD_US[period]
+        with self.lock:
+            history = dict(self.history[period])
+            if self.current[period]:
+                history[self.current[period][0]] = self.current[period][1]
+        return [history.get(number, 0) for number in range(last - n_periods + 1, last + 1)]
+
+
+    def flow_gpm(self, when):
+        """ Gallons per minute from the time between the last two meter changes. Decays
+            when the next one is overdue, and is 0 after a minute with none.
+        """
+        with self.lock:
+            if self.last_us is None or self.interval_us is None:
+                return 0.0
+            since_us = to_us(when) - self.last_us
+            if since_us > PERIOD_US['minute']:
+                return 0.0
+            interval_us = max(self.interval_us, since_us, 1)
+        return CUFT_PER_TICK * GALLONS_PER_CUFT * 60e6 / interval_us
+
+
+    def leak(self, when):
+        """ True if water has run every minute for at least leak_minutes up to now.
+        """
+        minute = to_us(when) // PERIOD_US['minute']
+        with self.lock:
+            if self.streak_minute is None or minute - self.streak_minute > 1:
+                return False
+            return self.streak >= self.leak_minutes
+
+
+def test(opts):
+    """ Count a morning's meter changes, restart partway through the hour and keep
+        counting, then restart again and check the totals came back.
+        opts is a dict of command line options
+    """
+    rollup_file = opts['--rollup']
+    if os.path.exists(rollup_file):
+        os.remove(rollup_file)
+    start = datetime(2024, 3, 1, 8, 30)
+    when = [start + timedelta(seconds=10 * i) for i in range(250)]  # to 09:11:30
+
+    agg = FlowAggregator(rollup_file)
+    for a_time in when[:100]:
+        agg.add(a_time)
+    agg.flush()             # what pi_daemon does at shutdown
+    flush_logs()
+
+    agg = FlowAggregator(rollup_file)
+    assert agg.count('day', start) == 100, agg.count('day', start)
+    assert agg.count('hour', start) == 100, agg.count('hour', start)
+    for a_time in when[100:]:
+        agg.add(a_time)
+    assert agg.count('day', start) == 250, agg.count('day', start)
+    assert agg.count('hour', start) == 180, agg.count('hour', start)    # 08:30 to 09:00
+    agg.flush()
+    flush_logs()
+
+    agg = FlowAggregator(rollup_file)
+    assert agg.recent('hour', 2, when[-1]) == [180, 70], agg.recent('hour', 2, when[-1])
+    assert agg.count('day', start) == 250, agg.count('day', start)
+    agg.add(when[-1] + timedelta(seconds=10))
+    assert agg.recent('hour', 2, when[-1]) == [180, 71], agg.recent('hour', 2, when[-1])
+    print('passed')
+
+
+if __name__ == '__main__':
+    import docopt
+    opts = docopt.docopt(usage_text, version='0.0.3')
+    test(opts)
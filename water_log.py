@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+""" water_log.py
+    A compact binary version of the CaptureEncoder water log.
+
+    The text log is one '%y-%m-%d %H:%M:%S.%f' line per meter change and years of it
+    have to be re-parsed every time somebody wants a number. The binary log is an 8 byte
+    header then one little endian int64 per meter change: microseconds since 1970-01-01
+    UTC. Not local time like the text log: that repeats an hour when daylight saving
+    ends and the searches need time to only go forward. to_us() takes a naive datetime
+    as local time, so queries can still be in local time.
+
+    Next to it, <file>.idx holds the timestamp of every INDEX_STRIDE'th record. A reader
+    mmaps the log, bisects the small index to find the block and then bisects inside the
+    block, so a range query touches a couple of pages no matter how big the log gets.
+    The log and the index are flushed separately, so after a power cut either can be
+    ahead. The reader trims the index to the log, fills in what's missing and rebuilds
+    it if its last entry isn't the record it should be, all in memory: the writer may be
+    appending to the file. The writer checks every entry when it opens the log and
+    writes the index back if it had to fix it, before appending to both.
+
+    The searches assume time only goes forward. A pi without a clock battery can log a
+    few ticks with the wrong date before NTP catches up; convert sorts them.
+
+    Each meter change is 0.05 cubic foot.
+"""
+
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+import mmap
+import os
+import struct
+import sys
+
+from log_sink import open_log
+
+usage_text = """
+ Usage:
+  water_log  convert <text> <bin>
+  water_log  usage <bin> <start> <end>
+  water_log -h | --help
+
+ Options:
+  -h --help               Show this screen.
+
+ Dates are yy-mm-dd or 'yy-mm-dd HH:MM:SS'. The end is not included.
+    """
+
+MAGIC = b'WATRLOG2'           # 1 was local time
+HEADER_LEN = len(MAGIC)
+INDEX_STRIDE = 512          # records per index entry. One 4 kB page of log
+CUFT_PER_TICK = 0.05
+GALLONS_PER_CUFT = 7.48052
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_US = timedelta(microseconds=1)
+
+assert sys.byteorder == 'little'     # the reader casts the mmap straight to int64
+
+
+def to_us(when):
+    """ A datetime to log microseconds, UTC. A naive one is local time.
+    """
+    return (when.astimezone(timezone.utc) - EPOCH) // ONE_US
+
+
+def from_us(us):
+    """ Log microseconds to a UTC datetime. .astimezone() it to show it.
+    """
+    return EPOCH + timedelta(microseconds=us)
+
+
+def parse_text_time(line):
+    """ Parse a text log line, '%y-%m-%d %H:%M:%S.%f', a lot faster than strptime.
+    """
+    return datetime(2000 + int(line[0:2]), int(line[3:5]), int(line[6:8]),
+                    int(line[9:11]), int(line[12:14]), int(line[15:17]),
+                    int(line[18:24].ljust(6, '0')) if len(line) > 18 else 0)
+
+
+def parse_date(text):
+    """ yy-mm-dd or yy-mm-dd HH:MM:SS from the command line.
+    """
+    if len(text) <= 8:
+        text += ' 00:00:00'
+    return parse_text_time(text)
+
+
+class WaterLogWriter():
+    """ Append meter changes to a binary log (and its index) through log_sink.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        size = os.path.getsize(file_name) if os.path.exists(file_name) else 0
+        if size < HEADER_LEN:
+            with open(file_name, 'wb') as fout:
+                fout.write(MAGIC)
+            size = HEADER_LEN
+        with WaterLogReader(file_name, check=True) as log:     # an index that matches
+            self.n_records = len(log)
+            if log.index_fixed:
+                tmp_name = file_name + '.idx.tmp'
+                with open(tmp_name, 'wb') as f_idx:
+                    log.index.tofile(f_idx)
+                os.replace(tmp_name, file_name + '.idx')
+        if self.n_records * 8 + HEADER_LEN != size:     # a half record from a power cut
+            with open(file_name, 'r+b') as fout:
+                fout.truncate(self.n_records * 8 + HEADER_LEN)
+        self.log = open_log(file_name, binary=True)
+        self.index = open_log(file_name + '.idx', binary=True)
+
+
+    def append(self, when):
+        """ Log one meter change at datetime when.
+        """
+        record = struct.pack('<q', to_us(when))
+        if self.n_records % INDEX_STRIDE == 0:
+            self.index.write(record)
+        self.log.write(record)
+        self.n_records += 1
+
+
+class WaterLogReader():
+    """ Memory map a binary water log for range queries.
+            with WaterLogReader('waterlog.bin') as log:
+                ticks = log.count(datetime(2024, 3, 1), datetime(2024, 4, 1))
+    """
+
+    def __init__(self, file_name, check=False):
+        self.file_name = file_name
+        self.f_in = open(file_name, 'rb')
+        size = os.fstat(self.f_in.fileno()).st_size
+        self.mm = None
+        self.times = memoryview(b'').cast('q')
+        if size > HEADER_LEN:
+            self.mm = mmap.mmap(self.f_in.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.mm[:HEADER_LEN] == b'WATRLOG1':
+                raise ValueError('%s has local times, convert the text log again'%(file_name,))
+            if self.mm[:HEADER_LEN] != MAGIC:
+                raise ValueError('%s is not a binary water log'%(file_name,))
+            n_records = (size - HEADER_LEN) // 8
+            self.times = memoryview(self.mm)[HEADER_LEN:HEADER_LEN + 8 * n_records].cast('q')
+        self.index_fixed = False    # the index in memory isn't the one in the file
+        self.index = self.load_index(check)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        self.times.release()
+        if self.mm:
+            self.mm.close()
+        self.f_in.close()
+
+
+    def __len__(self):
+        return len(self.times)
+
+
+    def load_index(self, check=False):
+        """ Read <file>.idx, fit it to the log and add any entries the writer didn't get
+            to. check compares every entry with the log, not just the last one.
+            The file is left alone, the writer may be appending to it.
+        """
+        index = array('q')
+        idx_name = self.file_name + '.idx'
+        data = b''
+        if os.path.exists(idx_name):
+            with open(idx_name, 'rb') as f_idx:
+                data = f_idx.read()
+            index.frombytes(data[:len(data) - len(data) % 8])
+        n_wanted = (len(self.times) + INDEX_STRIDE - 1) // INDEX_STRIDE
+        del index[n_wanted:]
+        if check:
+            good = index == array('q', self.times[:len(index) * INDEX_STRIDE:INDEX_STRIDE])
+        else:
+            good = not index or index[-1] == self.times[(len(index) - 1) * INDEX_STRIDE]
+        if not good:
+            del index[:]
+        if len(index) < n_wanted:
+            have = len(index)
+            index.extend(self.times[i * INDEX_STRIDE] for i in range(have, n_wanted))
+        self.index_fixed = not good or len(index) * 8 != len(data)
+        return index
+
+
+    def find(self, when):
+        """ Position of the first record at or after datetime when.
+        """
+        us = to_us(when)
+        block = bisect_left(self.index, us)
+        lo = max(block - 1, 0) * INDEX_STRIDE
+        hi = min(block * INDEX_STRIDE, len(self.times))
+        return bisect_left(self.times, us, lo, hi)
+
+
+    def ticks(self, start, end):
+        """ The timestamps (us) from start up to but not including end, as a memoryview.
+        """
+        return self.times[self.find(start):self.find(end)]
+
+
+    def count(self, start, end):
+        """ The number of meter changes from start up to but not including end.
+        """
+        return self.find(end) - self.find(start)
+
+
+def convert(text_name, bin_name):
+    """ Build a binary log (and index) from a text log. Returns the record count.
+    """
+    times = array('q')
+    with open(text_name) as f_in:
+        for line in f_in:
+            line = line.strip()
+            if line:
+                when = parse_text_time(line)
+                us = to_us(when)
+                if times and us < times[-1]:    # the second time through a fall back hour
+                    us = max(us, to_us(when.replace(fold=1)))
+                times.append(us)
+    times = array('q', sorted(times))
+    with open(bin_name, 'wb') as fout:
+        fout.write(MAGIC)
+        times.tofile(fout)
+    with open(bin_name + '.idx', 'wb') as f_idx:
+        times[::INDEX_STRIDE].tofile(f_idx)
+    return len(times)
+
+
+if __name__ == '__main__':
+    import docopt
+    opts = docopt.docopt(usage_text, version='0.0.3')
+    if opts['convert']:
+        print(convert(opts['<text>'], opts['<bin>']), 'records')
+    elif opts['usage']:
+        with WaterLogReader(opts['<bin>']) as water_log:
+            n_ticks = water_log.count(parse_date(opts['<start>']), parse_date(opts['<end>']))
+        cu_ft = n_ticks * CUFT_PER_TICK
+        print('%d ticks, %.2f cubic feet, %.1f gallons'%(n_ticks, cu_ft, cu_ft * GALLONS_PER_CUFT))